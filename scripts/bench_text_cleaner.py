@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+"""
+Замер скорости и проверка эквивалентности text_cleaner.
+
+Сравнивает normalize_text из scripts/text_cleaner.py
+с прежней реализацией (копия ниже) на одних и тех же текстах:
+результаты должны совпадать символ в символ, иначе скрипт завершается с кодом 1.
+
+Запуск:
+    python scripts/bench_text_cleaner.py                 # встроенные примеры
+    python scripts/bench_text_cleaner.py messages.jsonl  # свои тексты: по строке JSON с полем text
+"""
+
+import json
+import random
+import re
+import sys
+import timeit
+
+from text_cleaner import normalize_text
+
+
+# --- Прежняя реализация (эталон) ---
+def legacy_normalize_text(text: str) -> str:
+    if not text:
+        return ""
+    month_map = {
+        'ЯНВАРЯ': 'января', 'ФЕВРАЛЯ': 'февраля', 'МАРТА': 'марта',
+        'АПРЕЛЯ': 'апреля', 'МАЯ': 'мая', 'ИЮНЯ': 'июня',
+        'ИЮЛЯ': 'июля', 'АВГУСТА': 'августа', 'СЕНТЯБРЯ': 'сентября',
+        'ОКТЯБРЯ': 'октября', 'НОЯБРЯ': 'ноября', 'ДЕКАБРЯ': 'декабря'
+    }
+
+    def replace_month(match):
+        return month_map.get(match.group(0).upper(), match.group(0))
+
+    month_pattern = re.compile('|'.join(month_map.keys()), re.IGNORECASE)
+    return month_pattern.sub(replace_month, text)
+
+
+# --- Примеры в духе реальных анонсов из каналов ---
+SAMPLES = [
+    "",
+    "Просто текст без разметки, 12 марта в 19:00.",
+    "**ДЖАЗОВЫЙ ВЕЧЕР** 🎷\n\n📅 15 МАРТА, 20:00\n📍 Бар [Луна](https://maps.app.goo.gl/abc)\n💰 500 ₽\n\nЗапись: @jazz_club_bot",
+    "__Лекция__ «История города»\n*Вход свободный*\nПодробнее: [сайт](https://example.com/event?id=1&ref=tg)",
+    "<b>Концерт</b> <i>камерной музыки</i>\n1 ДЕКАБРЯ и 2 декабря\n<a href=\"https://t.me/some_channel\">канал</a>",
+    "***Важно!*** Регистрация до 30 АПРЕЛЯ: `bit.ly/reg_2024`\n```\nкод: SPRING_2024\n```",
+    "Мастер-класс ___по керамике___ для детей 6+\nВедущая — @anna_ceramics\nСтоимость: 1 500 ₽ / 2_000 ₽ за двоих",
+    "Кинопоказ 😎 **«Сталкер»**\n\n**Когда:** 7 ноября, 19:30\n**Где:** [Дом кино](https://t.me/dom_kino)\n\n#кино #show_time",
+    "Йога на крыше 🧘 каждое воскресенье ИЮНЯ, ИЮЛЯ и АВГУСТА\nСбор в 8:00, коврик с собой * по желанию",
+    "Список:\n* пункт один\n* пункт два\n_конец_ списка и snake_case_name в тексте",
+    "```многострочный\nблок кода```` и `inline` и незакрытый ` символ",
+    "Маркет выходного дня 🎪 21–22 СЕНТЯБРЯ\n<p>Вход бесплатный</p>\n[Регистрация](https://forms.gle/x) | [Карта](https://yandex.ru/maps/-/abc)",
+]
+
+FRAGMENTS = [
+    "**жирный**", "__подчеркнутый__", "*курсив*", "_курсив_", "***все сразу***", "___и так___",
+    "`код`", "```блок\nкода```", "<b>тег</b>", "<br>", "[ссылка](https://example.com/a_b)",
+    "@user_name", "snake_case", "5 * 3", "a_b_c", "МАРТА", "Мая", "января", "15 ОКТЯБРЯ 19:00",
+    "📅", "\n", " ", "текст", "Event", "[без ссылки]", "(скобки)", "< не тег", "2 > 1",
+    "ᲂктября", "İstanbul", "НОЯБРЯ", "ДЕКᲀБРЯ", "ᲄᲅ",
+]
+
+
+def generated_samples(count: int = 2000, seed: int = 42) -> list:
+    """Случайные сочетания фрагментов разметки — для проверки граничных случаев."""
+    rng = random.Random(seed)
+    return [''.join(rng.choice(FRAGMENTS) for _ in range(rng.randint(1, 40))) for _ in range(count)]
+
+
+def load_samples(path: str) -> list:
+    texts = []
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                texts.append(json.loads(line).get('text') or '')
+    return texts
+
+
+def check_equivalence(texts: list) -> int:
+    mismatches = 0
+    for text in texts:
+        expected, actual = legacy_normalize_text(text), normalize_text(text)
+        if expected != actual:
+            mismatches += 1
+            if mismatches <= 5:
+                print(f"❌ normalize_text расходится с эталоном:\n  вход:     {text!r}\n  эталон:   {expected!r}\n  получено: {actual!r}")
+    return mismatches
+
+
+def bench(func, texts: list, repeat: int = 5) -> float:
+    """Лучшее время одного прохода по всем текстам, секунд."""
+    return min(timeit.repeat(lambda: [func(t) for t in texts], number=1, repeat=repeat))
+
+
+def main():
+    if len(sys.argv) > 1:
+        texts = bench_texts = load_samples(sys.argv[1])
+    else:
+        # Эквивалентность — на примерах и случайных сочетаниях (с редкими символами),
+        # скорость — только на примерах, похожих на реальные сообщения
+        texts = SAMPLES + generated_samples()
+        bench_texts = SAMPLES * 200
+    print(f"Текстов для проверки: {len(texts)}, для замера: {len(bench_texts)}")
+
+    mismatches = check_equivalence(texts)
+    if mismatches:
+        print(f"❌ Расхождений с эталоном: {mismatches}")
+        sys.exit(1)
+    print("✅ Результаты совпадают с прежней реализацией.")
+
+    old_time, new_time = bench(legacy_normalize_text, bench_texts), bench(normalize_text, bench_texts)
+    print(f"normalize_text: было {old_time * 1000:.1f} мс, стало {new_time * 1000:.1f} мс "
+          f"(ускорение ×{old_time / new_time:.1f})")
+
+
+if __name__ == '__main__':
+    main()
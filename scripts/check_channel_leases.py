@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+"""
+Проверка аренды каналов (CHANNEL_LEASES) без Supabase.
+
+Функции claim/renew/keep/release из unified_importer работают с маленькой заменой
+PostgREST в памяти (httpx.MockTransport): одна строка channel_sync_state и те же
+фильтры eq./is.null/lt./or=(...), что понимает настоящий PostgREST. Сценарий:
+захват, отказ второму воркеру, продление, перехват после истечения аренды,
+сигнал lease_lost у потерявшего аренду воркера и освобождение.
+
+Запуск:
+    python scripts/check_channel_leases.py
+При ошибке скрипт завершается с кодом 1.
+"""
+
+import asyncio
+import json
+import re
+import sys
+from datetime import datetime
+
+import httpx
+
+import unified_importer as ui
+
+SUPABASE_URL = 'http://postgrest.local'
+LEASE_TTL = 0.6  # секунд: сценарий с истечением аренды занимает около секунды
+
+
+def _matches(row: dict, column: str, op: str, value: str) -> bool:
+    value = value.strip('"')
+    current = row.get(column)
+    if op == 'is':
+        return current is None if value == 'null' else str(current).lower() == value
+    if op == 'eq':
+        return current is not None and str(current) == value
+    if op == 'lt':
+        return current is not None and datetime.fromisoformat(current) < datetime.fromisoformat(value)
+    raise ValueError(f"Фильтр {op} не поддерживается")
+
+
+def _row_matches(row: dict, params) -> bool:
+    for key, value in params.multi_items():
+        if key == 'or':
+            conditions = re.findall(r'([a-z_]+)\.([a-z]+)\.("[^"]*"|[^,)]+)', value)
+            if not any(_matches(row, c, op, v) for c, op, v in conditions):
+                return False
+        else:
+            op, _, operand = value.partition('.')
+            if not _matches(row, key, op, operand):
+                return False
+    return True
+
+
+def postgrest_stand_in(rows: list) -> httpx.MockTransport:
+    """PATCH /rest/v1/channel_sync_state: атомарный условный UPDATE, как в Postgres."""
+    def handler(request: httpx.Request) -> httpx.Response:
+        if request.method != 'PATCH' or request.url.path != '/rest/v1/channel_sync_state':
+            return httpx.Response(404, json={'message': 'not found'})
+        data = json.loads(request.content)
+        updated = []
+        for row in rows:
+            if _row_matches(row, request.url.params):
+                row.update(data)
+                updated.append(dict(row))
+        if 'return=representation' in request.headers.get('Prefer', ''):
+            return httpx.Response(200, json=updated)
+        return httpx.Response(204)
+    return httpx.MockTransport(handler)
+
+
+def check(condition: bool, message: str) -> bool:
+    print(f"{'✅' if condition else '❌'} {message}")
+    return condition
+
+
+async def run_checks() -> bool:
+    rows = [{'id': 5, 'channel_name': 'test_channel', 'lease_owner': None, 'lease_expires_at': None}]
+    channel = dict(rows[0])
+    worker_a = {'supabase_url': SUPABASE_URL, 'worker_id': 'host-a:1', 'lease_ttl': LEASE_TTL}
+    worker_b = {**worker_a, 'worker_id': 'host-b:2'}
+    headers = {'Content-Type': 'application/json'}
+    ok = True
+
+    async with httpx.AsyncClient(transport=postgrest_stand_in(rows)) as http_client:
+        claimed = await ui.claim_channel_lease(http_client, worker_a, headers, channel)
+        ok &= check(claimed is not None and rows[0]['lease_owner'] == 'host-a:1', "A захватывает свободный канал")
+        ok &= check(await ui.claim_channel_lease(http_client, worker_b, headers, channel) is None,
+                    "B не может захватить канал, пока аренда A действует")
+        ok &= check(await ui.claim_channel_lease(http_client, worker_a, headers, channel) is not None,
+                    "A повторно захватывает свой канал")
+        ok &= check(await ui.renew_channel_lease(http_client, worker_a, headers, channel), "A продлевает аренду")
+        ok &= check(not await ui.renew_channel_lease(http_client, worker_b, headers, channel),
+                    "B не может продлить чужую аренду")
+
+        await asyncio.sleep(LEASE_TTL + 0.1)
+        stolen = await ui.claim_channel_lease(http_client, worker_b, headers, channel)
+        ok &= check(stolen is not None and rows[0]['lease_owner'] == 'host-b:2',
+                    "B перехватывает канал после истечения аренды A")
+        ok &= check(not await ui.renew_channel_lease(http_client, worker_a, headers, channel),
+                    "A больше не может продлить аренду")
+
+        lease_lost = asyncio.Event()
+        keeper = asyncio.create_task(ui.keep_channel_lease(http_client, worker_a, headers, channel, lease_lost))
+        try:
+            await asyncio.wait_for(lease_lost.wait(), timeout=LEASE_TTL * 2)
+        except asyncio.TimeoutError:
+            pass
+        keeper.cancel()
+        ok &= check(lease_lost.is_set(), "keep_channel_lease у A выставляет lease_lost")
+
+        await ui.release_channel_lease(http_client, worker_a, headers, channel)
+        ok &= check(rows[0]['lease_owner'] == 'host-b:2', "Освобождение от A не снимает аренду B")
+        await ui.release_channel_lease(http_client, worker_b, headers, channel)
+        ok &= check(rows[0]['lease_owner'] is None and rows[0]['lease_expires_at'] is None, "B освобождает канал")
+
+    return ok
+
+
+def main():
+    ui.setup_logging()
+    if not asyncio.run(run_checks()):
+        sys.exit(1)
+    print("Аренда каналов работает как ожидается.")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+"""
+Дедупликация событий внутри запуска импортера.
+
+Ключ события строится по нормализованному названию (регистр, пунктуация и эмодзи
+не учитываются) и дате, опционально — по времени и месту. Индекс один на весь
+запуск, поэтому повторы одного анонса в разных каналах тоже отсекаются.
+
+FuzzyEventIndex — нечеткое сравнение с предстоящими событиями из базы
+("Концерт Джаз-бэнд" и "Джаз-бэнд: концерт"): индекс загружается один раз
+за запуск и пополняется по мере записи новых событий.
+"""
+
+import unicodedata
+from collections import defaultdict
+from typing import Optional
+
+
+def normalize_title(text: Optional[str]) -> str:
+    """Приводит строку к виду для сравнения: casefold, ё→е, только буквы и цифры через пробел."""
+    if not text:
+        return ''
+    text = unicodedata.normalize('NFKC', text).casefold().replace('ё', 'е')
+    # Все, что не буква и не цифра (пунктуация, эмодзи, символы), превращаем в пробел
+    chars = [ch if unicodedata.category(ch)[0] in 'LN' else ' ' for ch in text]
+    return ' '.join(''.join(chars).split())
+
+
+class EventDedupIndex:
+    """Множество ключей уже принятых событий с проверкой за O(1)."""
+
+    def __init__(self, match_time: bool = False, match_venue: bool = False):
+        self.match_time = match_time
+        self.match_venue = match_venue
+        self._keys = set()
+
+    def key(self, event: dict) -> tuple:
+        key = (normalize_title(event.get('title')), event.get('whenDay'))
+        if self.match_time:
+            key += ((event.get('whenTime') or '')[:5],)
+        if self.match_venue:
+            key += (normalize_title(event.get('where')),)
+        return key
+
+    def add(self, event: dict) -> bool:
+        """Добавляет событие. Возвращает False, если такое уже было."""
+        key = self.key(event)
+        if key in self._keys:
+            return False
+        self._keys.add(key)
+        return True
+
+    def __contains__(self, event: dict) -> bool:
+        return self.key(event) in self._keys
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+
+def trigrams(text: Optional[str]) -> frozenset:
+    """Триграммы слов нормализованной строки (порядок слов не важен)."""
+    grams = set()
+    for word in normalize_title(text).split():
+        padded = f"  {word} "
+        grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return frozenset(grams)
+
+
+def jaccard(a: frozenset, b: frozenset) -> float:
+    if not a or not b:
+        return 0.0
+    return len(a & b) / len(a | b)
+
+
+class FuzzyEventIndex:
+    """
+    Нечеткий индекс событий, разложенных по whenDay.
+    Сходство — коэффициент Жаккара по триграммам названия; если место указано
+    у обоих событий, оно учитывается с весом venue_weight, но может только поднять оценку.
+    Одинаковое нормализованное название в тот же день — всегда дубликат.
+    Индекс отвечает только за даты не раньше since (окно загрузки из базы).
+    """
+
+    def __init__(self, threshold: float = 0.8, since: Optional[str] = None, venue_weight: float = 0.25):
+        self.threshold = threshold
+        self.since = since
+        self.venue_weight = venue_weight
+        self._days = defaultdict(list)
+
+    def covers(self, day: Optional[str]) -> bool:
+        return bool(day) and self.since is not None and str(day) >= self.since
+
+    def similarity(self, a: tuple, b: tuple) -> float:
+        score = jaccard(a[0], b[0])
+        if a[1] and b[1]:
+            # По-разному записанное место ("Бар Луна" / "ул. Ленина, 5") не должно прятать дубликат
+            score = max(score, (1 - self.venue_weight) * score + self.venue_weight * jaccard(a[1], b[1]))
+        return score
+
+    def add(self, event: dict):
+        day = event.get('whenDay')
+        if day:
+            self._days[str(day)].append((trigrams(event.get('title')), trigrams(event.get('where')),
+                                         event.get('title'), normalize_title(event.get('title'))))
+
+    def find(self, event: dict) -> Optional[str]:
+        """Возвращает название похожего события из индекса или None."""
+        signature = (trigrams(event.get('title')), trigrams(event.get('where')))
+        if not signature[0]:
+            return None
+        title = normalize_title(event.get('title'))
+        best, best_score = None, self.threshold
+        for candidate in self._days.get(str(event.get('whenDay')), ()):
+            if candidate[3] == title:
+                return candidate[2]
+            score = self.similarity(signature, candidate)
+            if score >= best_score:
+                best, best_score = candidate[2], score
+        return best
+
+    def __len__(self) -> int:
+        return sum(len(v) for v in self._days.values())
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+"""
+Работа с изображениями постов: хэши для дедупликации загрузок.
+
+sha256 содержимого задает путь файла в Storage (одинаковые файлы из разных
+сообщений и каналов загружаются один раз), а перцептивный dHash находит
+пересжатые копии одного постера. process_image уменьшает фото до размера
+карточки и перекодирует в WebP/JPEG (вызывается в пуле процессов).
+Для dHash и обработки нужен Pillow; без него дедупликация работает только
+по точному совпадению содержимого, а фото загружаются как есть.
+"""
+
+import hashlib
+import io
+from typing import Optional
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+HAS_PIL = Image is not None
+
+
+def sha256_hex(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def content_path(sha256: str, ext: str = 'jpg', suffix: str = '') -> str:
+    """Путь в бакете по хэшу содержимого: ab/abcdef....jpg (с suffix — ab/abcdef..._thumb.jpg)."""
+    return f"{sha256[:2]}/{sha256}{suffix}.{ext}"
+
+
+def dhash(data: bytes, size: int = 8) -> Optional[int]:
+    """
+    Разностный хэш (dHash): картинка в оттенках серого уменьшается до (size+1)×size,
+    бит — «пиксель ярче правого соседа». Возвращает size*size-битное число или None,
+    если Pillow недоступен или файл не читается.
+    """
+    if Image is None:
+        return None
+    try:
+        with Image.open(io.BytesIO(data)) as img:
+            return _dhash_image(img, size)
+    except Exception:
+        return None
+
+
+def _dhash_image(img, size: int = 8) -> int:
+    pixels = list(img.convert('L').resize((size + 1, size), Image.LANCZOS).getdata())
+    value = 0
+    for row in range(size):
+        for col in range(size):
+            left = pixels[row * (size + 1) + col]
+            right = pixels[row * (size + 1) + col + 1]
+            value = (value << 1) | (left > right)
+    return value
+
+
+def hamming(a: int, b: int) -> int:
+    return bin(a ^ b).count('1')
+
+
+# Формат → (расширение файла, Content-Type)
+IMAGE_FORMATS = {
+    'webp': ('webp', 'image/webp'),
+    'jpeg': ('jpg', 'image/jpeg'),
+}
+
+
+def _encode(img, max_side: int, fmt: str, quality: int) -> bytes:
+    img = img.copy()
+    img.thumbnail((max_side, max_side), Image.LANCZOS)  # только уменьшает, пропорции сохраняются
+    out = io.BytesIO()
+    if fmt == 'jpeg':
+        img.save(out, 'JPEG', quality=quality, optimize=True, progressive=True)
+    else:
+        img.save(out, 'WEBP', quality=quality, method=4)
+    return out.getvalue()
+
+
+def process_image(data: bytes, max_side: int, fmt: str = 'webp', quality: int = 80,
+                  thumb_side: int = 0) -> Optional[dict]:
+    """
+    Готовит варианты для загрузки: {'image': bytes, 'thumb': bytes или None, 'dhash': int}.
+    Изображение вписывается в квадрат max_side (миниатюра — в thumb_side) и кодируется в fmt;
+    dHash считается по уже декодированной картинке, чтобы не делать этого в цикле событий.
+    Возвращает None, если Pillow недоступен или файл не читается, — тогда загружается оригинал.
+    Функция верхнего уровня: ее можно отдавать в ProcessPoolExecutor.
+    """
+    if Image is None or fmt not in IMAGE_FORMATS:
+        return None
+    try:
+        with Image.open(io.BytesIO(data)) as img:
+            img.load()
+            phash = _dhash_image(img)
+            if img.mode not in ('RGB', 'L') and not (fmt == 'webp' and img.mode == 'RGBA'):
+                img = img.convert('RGBA' if fmt == 'webp' and 'A' in img.getbands() else 'RGB')
+            return {
+                'image': _encode(img, max_side, fmt, quality),
+                'thumb': _encode(img, thumb_side, fmt, quality) if thumb_side > 0 else None,
+                'dhash': phash,
+            }
+    except Exception:
+        return None
@@ -0,0 +1,441 @@
+#!/usr/bin/env python3
+"""
+Локальное состояние импортера (SQLite).
+
+Хранит между запусками то, что не нужно (или дорого) держать в Supabase:
+кэш списка топиков форумов, чекпоинты по отдельным топикам, кэш сущностей
+каналов (access_hash), который теряется вместе с StringSession, pts каналов
+для getChannelDifference, журнал обработки сообщений (write-ahead), чтобы после
+сбоя не отправлять сообщения в LLM повторно, outbox — очередь записей в Supabase,
+которая отправляется пачками и переживает сбои сети и перезапуски, и индекс
+загруженных изображений (хэш содержимого и id фото Telegram -> публичный URL).
+Файл базы по умолчанию лежит в scripts/state/importer_state.db. Процесс держит
+блокировку файла (fcntl), поэтому второй воркер на той же машине берет следующий
+свободный файл: importer_state.1.db, importer_state.2.db и т.д.
+"""
+
+import itertools
+import json
+import os
+import sqlite3
+import time
+from typing import Optional
+
+from images import hamming
+
+try:
+    import fcntl
+except ImportError:  # Windows: блокировки нет, файл состояния общий
+    fcntl = None
+
+DEFAULT_STATE_PATH = os.path.join(os.path.dirname(__file__), 'state', 'importer_state.db')
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS forum_topics (
+    channel_id INTEGER NOT NULL,
+    topic_id INTEGER NOT NULL,
+    top_message INTEGER,
+    fetched_at REAL NOT NULL,
+    PRIMARY KEY (channel_id, topic_id)
+);
+
+CREATE TABLE IF NOT EXISTS forum_topics_fetch (
+    channel_id INTEGER PRIMARY KEY,
+    complete INTEGER NOT NULL,
+    fetched_at REAL NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS topic_checkpoints (
+    channel_id INTEGER NOT NULL,
+    topic_id INTEGER NOT NULL,
+    last_message_id INTEGER NOT NULL,
+    PRIMARY KEY (channel_id, topic_id)
+);
+
+CREATE TABLE IF NOT EXISTS entity_cache (
+    channel_id INTEGER PRIMARY KEY,
+    access_hash INTEGER NOT NULL,
+    username TEXT,
+    title TEXT,
+    is_forum INTEGER NOT NULL DEFAULT 0,
+    updated_at REAL NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS channel_pts (
+    channel_id INTEGER NOT NULL,
+    thread_id INTEGER NOT NULL DEFAULT 0,
+    pts INTEGER NOT NULL,
+    updated_at REAL NOT NULL,
+    PRIMARY KEY (channel_id, thread_id)
+);
+
+-- status: extracted (ответ LLM получен) -> prepared (записи для вставки готовы) -> persisted
+CREATE TABLE IF NOT EXISTS message_journal (
+    channel_id INTEGER NOT NULL,
+    message_id INTEGER NOT NULL,
+    status TEXT NOT NULL,
+    extraction TEXT,
+    rows TEXT,
+    updated_at REAL NOT NULL,
+    PRIMARY KEY (channel_id, message_id)
+);
+
+CREATE INDEX IF NOT EXISTS message_journal_status ON message_journal (status);
+
+-- kind: posts / events (payload — список строк, meta — {channel_id}),
+-- channel_state (payload — данные PATCH, meta — {filter, channel_id})
+-- status: pending -> (удаляется после отправки) или dead (постоянная ошибка, хранится для разбора)
+CREATE TABLE IF NOT EXISTS outbox (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    kind TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    meta TEXT,
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt_at REAL NOT NULL DEFAULT 0,
+    last_error TEXT,
+    created_at REAL NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS outbox_status ON outbox (status, id);
+
+-- Загруженные в Storage изображения: sha256 содержимого -> URL, dhash (hex) для пересжатых копий
+CREATE TABLE IF NOT EXISTS images (
+    sha256 TEXT PRIMARY KEY,
+    url TEXT NOT NULL,
+    dhash TEXT,
+    created_at REAL NOT NULL
+);
+
+-- id фото Telegram -> sha256: повторно встреченное фото не скачивается
+CREATE TABLE IF NOT EXISTS telegram_photos (
+    photo_id INTEGER PRIMARY KEY,
+    sha256 TEXT NOT NULL
+);
+"""
+
+
+def _lock_file(path: str):
+    """Эксклюзивная блокировка path + '.lock'; None, если файл уже занят другим процессом."""
+    lock = open(path + '.lock', 'w')
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        lock.close()
+        return None
+    return lock
+
+
+class LocalState:
+    """Обертка над SQLite-файлом с локальным состоянием импортера."""
+
+    def __init__(self, path: Optional[str] = None, lock=None):
+        self.path = path or DEFAULT_STATE_PATH
+        self.lock = lock
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        self.conn = sqlite3.connect(self.path)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.executescript(_SCHEMA)
+        self.conn.commit()
+
+    @classmethod
+    def open_exclusive(cls, path: Optional[str] = None) -> 'LocalState':
+        """
+        Открывает первый не занятый другим процессом файл: path, затем path.1, path.2 ...
+        OUTBOX_LOCK защищает outbox только внутри процесса, поэтому файл у каждого воркера свой.
+        """
+        path = path or DEFAULT_STATE_PATH
+        if fcntl is None:
+            return cls(path)
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        base, ext = os.path.splitext(path)
+        for slot in itertools.count():
+            candidate = path if slot == 0 else f"{base}.{slot}{ext}"
+            lock = _lock_file(candidate)
+            if lock is not None:
+                return cls(candidate, lock)
+
+    def close(self):
+        self.conn.close()
+        if self.lock is not None:
+            self.lock.close()
+
+    # --- Топики форумов ---
+    def get_forum_topics(self, channel_id: int, ttl: int) -> Optional[tuple]:
+        """
+        Возвращает (topics, complete) из кэша, если он моложе ttl секунд.
+        topics — словарь {topic_id: top_message}.
+        """
+        if ttl <= 0:
+            return None
+        row = self.conn.execute(
+            "SELECT complete, fetched_at FROM forum_topics_fetch WHERE channel_id = ?",
+            (channel_id,)
+        ).fetchone()
+        if row is None or time.time() - row['fetched_at'] > ttl:
+            return None
+
+        rows = self.conn.execute(
+            "SELECT topic_id, top_message FROM forum_topics WHERE channel_id = ?",
+            (channel_id,)
+        ).fetchall()
+        return {r['topic_id']: r['top_message'] for r in rows}, bool(row['complete'])
+
+    def save_forum_topics(self, channel_id: int, topics: dict, complete: bool):
+        """Сохраняет полученный список топиков ({topic_id: top_message})."""
+        now = time.time()
+        with self.conn:
+            self.conn.execute("DELETE FROM forum_topics WHERE channel_id = ?", (channel_id,))
+            self.conn.executemany(
+                "INSERT INTO forum_topics (channel_id, topic_id, top_message, fetched_at) VALUES (?, ?, ?, ?)",
+                [(channel_id, topic_id, top_message, now) for topic_id, top_message in topics.items()]
+            )
+            self.conn.execute(
+                "INSERT OR REPLACE INTO forum_topics_fetch (channel_id, complete, fetched_at) VALUES (?, ?, ?)",
+                (channel_id, int(complete), now)
+            )
+
+    def invalidate_forum_topics(self, channel_id: int):
+        """Сбрасывает кэш топиков: их top_message устарели (в канале появились сообщения)."""
+        with self.conn:
+            self.conn.execute("DELETE FROM forum_topics_fetch WHERE channel_id = ?", (channel_id,))
+
+    def get_topic_checkpoint(self, channel_id: int, topic_id: int) -> int:
+        row = self.conn.execute(
+            "SELECT last_message_id FROM topic_checkpoints WHERE channel_id = ? AND topic_id = ?",
+            (channel_id, topic_id)
+        ).fetchone()
+        return row['last_message_id'] if row else 0
+
+    def set_topic_checkpoint(self, channel_id: int, topic_id: int, message_id: int):
+        """Двигает чекпоинт топика вперед (никогда не назад)."""
+        with self.conn:
+            self.conn.execute(
+                """
+                INSERT INTO topic_checkpoints (channel_id, topic_id, last_message_id) VALUES (?, ?, ?)
+                ON CONFLICT (channel_id, topic_id)
+                DO UPDATE SET last_message_id = MAX(last_message_id, excluded.last_message_id)
+                """,
+                (channel_id, topic_id, message_id)
+            )
+
+    # --- Кэш сущностей каналов ---
+    def get_cached_entity(self, channel_id: Optional[int] = None, username: Optional[str] = None) -> Optional[dict]:
+        """
+        Ищет канал в кэше по "голому" ID (без -100) или по юзернейму.
+        Возвращает словарь с полями channel_id, access_hash, username, title, is_forum.
+        """
+        if channel_id is not None:
+            row = self.conn.execute("SELECT * FROM entity_cache WHERE channel_id = ?", (channel_id,)).fetchone()
+        elif username:
+            row = self.conn.execute(
+                "SELECT * FROM entity_cache WHERE lower(username) = ?",
+                (username.lstrip('@').lower(),)
+            ).fetchone()
+        else:
+            return None
+        return dict(row) if row else None
+
+    def save_entity(self, channel_id: int, access_hash: int, username: Optional[str], title: Optional[str], is_forum: bool):
+        with self.conn:
+            self.conn.execute(
+                """
+                INSERT OR REPLACE INTO entity_cache (channel_id, access_hash, username, title, is_forum, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?)
+                """,
+                (channel_id, access_hash, username, title, int(bool(is_forum)), time.time())
+            )
+
+    def invalidate_entity(self, channel_id: int):
+        with self.conn:
+            self.conn.execute("DELETE FROM entity_cache WHERE channel_id = ?", (channel_id,))
+
+    # --- pts каналов (updates.getChannelDifference) ---
+    # Ключ — канал и thread_id строки channel_sync_state: один канал может быть
+    # настроен несколькими строками (по топикам), и у каждой свой прогресс.
+    def get_channel_pts(self, channel_id: int, thread_id: Optional[int] = None) -> Optional[int]:
+        row = self.conn.execute(
+            "SELECT pts FROM channel_pts WHERE channel_id = ? AND thread_id = ?",
+            (channel_id, thread_id or 0)
+        ).fetchone()
+        return row['pts'] if row else None
+
+    def set_channel_pts(self, channel_id: int, pts: int, thread_id: Optional[int] = None):
+        with self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO channel_pts (channel_id, thread_id, pts, updated_at) VALUES (?, ?, ?, ?)",
+                (channel_id, thread_id or 0, pts, time.time())
+            )
+
+    # --- Журнал обработки сообщений ---
+    def get_journal_entry(self, channel_id: int, message_id: int) -> Optional[dict]:
+        row = self.conn.execute(
+            "SELECT status, extraction FROM message_journal WHERE channel_id = ? AND message_id = ?",
+            (channel_id, message_id)
+        ).fetchone()
+        if row is None:
+            return None
+        return {
+            'status': row['status'],
+            'extraction': json.loads(row['extraction']) if row['extraction'] else None
+        }
+
+    def journal_extraction(self, channel_id: int, message_id: int, extraction):
+        """Фиксирует ответ LLM сразу после получения."""
+        with self.conn:
+            self.conn.execute(
+                """
+                INSERT OR REPLACE INTO message_journal (channel_id, message_id, status, extraction, rows, updated_at)
+                VALUES (?, ?, 'extracted', ?, NULL, ?)
+                """,
+                (channel_id, message_id, json.dumps(extraction, ensure_ascii=False), time.time())
+            )
+
+    def journal_prepared(self, channel_id: int, message_id: int, rows: list):
+        """Фиксирует готовые к вставке записи. Сообщение без записей сразу считается сохраненным."""
+        status = 'prepared' if rows else 'persisted'
+        with self.conn:
+            self.conn.execute(
+                "UPDATE message_journal SET status = ?, rows = ?, updated_at = ? WHERE channel_id = ? AND message_id = ?",
+                (status, json.dumps(rows, ensure_ascii=False), time.time(), channel_id, message_id)
+            )
+
+    def _mark_journal_persisted(self, channel_id: int, message_ids: list):
+        self.conn.executemany(
+            "UPDATE message_journal SET status = 'persisted', updated_at = ? WHERE channel_id = ? AND message_id = ?",
+            [(time.time(), channel_id, message_id) for message_id in message_ids]
+        )
+
+    def get_prepared_journal(self) -> dict:
+        """Возвращает {channel_id: [(message_id, rows), ...]} для записей, не дошедших до базы."""
+        pending = {}
+        for row in self.conn.execute(
+            "SELECT channel_id, message_id, rows FROM message_journal WHERE status = 'prepared' ORDER BY channel_id, message_id"
+        ):
+            pending.setdefault(row['channel_id'], []).append((row['message_id'], json.loads(row['rows'])))
+        return pending
+
+    def prune_journal(self, retention_days: int):
+        """Удаляет сохраненные записи журнала старше retention_days."""
+        with self.conn:
+            self.conn.execute(
+                "DELETE FROM message_journal WHERE status = 'persisted' AND updated_at < ?",
+                (time.time() - retention_days * 86400,)
+            )
+
+    # --- Outbox (очередь записей в Supabase) ---
+    def enqueue_writes(self, writes: list, journal_channel_id: Optional[int] = None, journal_message_ids: tuple = ()):
+        """
+        Ставит записи в outbox одной транзакцией. writes — список (kind, payload, meta).
+        Если переданы сообщения журнала, они в той же транзакции помечаются как сохраненные:
+        с этого момента данные не потеряются, даже если Supabase недоступен.
+        """
+        now = time.time()
+        with self.conn:
+            self.conn.executemany(
+                "INSERT INTO outbox (kind, payload, meta, created_at) VALUES (?, ?, ?, ?)",
+                [
+                    (kind, json.dumps(payload, ensure_ascii=False), json.dumps(meta, ensure_ascii=False) if meta else None, now)
+                    for kind, payload, meta in writes
+                ]
+            )
+            if journal_channel_id is not None and journal_message_ids:
+                self._mark_journal_persisted(journal_channel_id, journal_message_ids)
+
+    def outbox_pending(self, limit: int = 1000) -> list:
+        """Записи в порядке постановки (порядок важен: чекпоинт идет после данных)."""
+        rows = self.conn.execute(
+            "SELECT id, kind, payload, meta, attempts, next_attempt_at FROM outbox WHERE status = 'pending' ORDER BY id LIMIT ?",
+            (limit,)
+        ).fetchall()
+        return [
+            {
+                'id': r['id'],
+                'kind': r['kind'],
+                'payload': json.loads(r['payload']),
+                'meta': json.loads(r['meta']) if r['meta'] else None,
+                'attempts': r['attempts'],
+                'next_attempt_at': r['next_attempt_at']
+            }
+            for r in rows
+        ]
+
+    def outbox_done(self, ids: list):
+        with self.conn:
+            self.conn.executemany("DELETE FROM outbox WHERE id = ?", [(i,) for i in ids])
+
+    def outbox_retry(self, ids: list, error: str, delay: float):
+        with self.conn:
+            self.conn.executemany(
+                "UPDATE outbox SET attempts = attempts + 1, next_attempt_at = ?, last_error = ? WHERE id = ?",
+                [(time.time() + delay, error, i) for i in ids]
+            )
+
+    def outbox_dead(self, ids: list, error: str):
+        with self.conn:
+            self.conn.executemany(
+                "UPDATE outbox SET status = 'dead', attempts = attempts + 1, last_error = ? WHERE id = ?",
+                [(error, i) for i in ids]
+            )
+
+    def outbox_dead_channels(self) -> set:
+        """Каналы (meta.channel_id), у которых данные posts/events лежат в dead."""
+        rows = self.conn.execute(
+            "SELECT DISTINCT json_extract(meta, '$.channel_id') AS channel_id FROM outbox "
+            "WHERE status = 'dead' AND kind IN ('posts', 'events') AND meta IS NOT NULL"
+        ).fetchall()
+        return {r['channel_id'] for r in rows if r['channel_id'] is not None}
+
+    def outbox_requeue_dead(self) -> int:
+        """Возвращает записи dead в очередь (после исправления данных или схемы). Порядок id сохраняется."""
+        with self.conn:
+            cur = self.conn.execute(
+                "UPDATE outbox SET status = 'pending', attempts = 0, next_attempt_at = 0 WHERE status = 'dead'"
+            )
+        return cur.rowcount
+
+    def outbox_counts(self) -> dict:
+        return {
+            r['status']: r['n']
+            for r in self.conn.execute("SELECT status, COUNT(*) AS n FROM outbox GROUP BY status")
+        }
+
+    # --- Индекс изображений ---
+    def get_image_by_photo(self, photo_id: int) -> Optional[str]:
+        row = self.conn.execute(
+            "SELECT i.url FROM telegram_photos t JOIN images i ON i.sha256 = t.sha256 WHERE t.photo_id = ?",
+            (photo_id,)
+        ).fetchone()
+        return row['url'] if row else None
+
+    def get_image_by_hash(self, sha256: str) -> Optional[str]:
+        row = self.conn.execute("SELECT url FROM images WHERE sha256 = ?", (sha256,)).fetchone()
+        return row['url'] if row else None
+
+    def find_similar_image(self, dhash: int, max_distance: int) -> Optional[tuple]:
+        """Ближайшее по dHash изображение в пределах max_distance бит: (sha256, url) или None."""
+        best, best_distance = None, max_distance + 1
+        for row in self.conn.execute("SELECT sha256, url, dhash FROM images WHERE dhash IS NOT NULL"):
+            distance = hamming(int(row['dhash'], 16), dhash)
+            if distance < best_distance:
+                best, best_distance = (row['sha256'], row['url']), distance
+        return best
+
+    def save_image(self, sha256: str, url: str, dhash: Optional[int] = None, photo_id: Optional[int] = None):
+        with self.conn:
+            self.conn.execute(
+                "INSERT OR IGNORE INTO images (sha256, url, dhash, created_at) VALUES (?, ?, ?, ?)",
+                (sha256, url, f"{dhash:016x}" if dhash is not None else None, time.time())
+            )
+            if photo_id is not None:
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO telegram_photos (photo_id, sha256) VALUES (?, ?)",
+                    (photo_id, sha256)
+                )
+
+    def link_photo(self, photo_id: int, sha256: str):
+        with self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO telegram_photos (photo_id, sha256) VALUES (?, ?)",
+                (photo_id, sha256)
+            )
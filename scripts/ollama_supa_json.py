@@ -6,12 +6,15 @@ Ollama Supa JSON Extractor
 """
 
 import asyncio
+import contextlib
 import os
 import json
 import httpx
 import sys
 from datetime import datetime
 
+from sinks import create_sink
+
 def print_header():
     print("="*60)
     print("OLLAMA JSON EXTRACTOR ДЛЯ SUPABASE")
@@ -53,6 +56,11 @@ def load_config():
         print("\nПожалуйста, установите переменные окружения:")
         print("  MY_SUPABASE_URL, MY_SUPABASE_SERVICE_ROLE_KEY")
         return None
+
+    # Куда писать результат (см. scripts/sinks.py); посты для обработки всегда читаются из Supabase
+    config['sink'] = os.getenv('SINK', 'supabase').lower()
+    config['database_url'] = os.getenv('DATABASE_URL', '')
+    config['sink_path'] = os.getenv('SINK_PATH', '')
     
     return config
 
@@ -181,7 +189,8 @@ async def update_posts_with_ollama_json():
 
     print_info("Подключение к Supabase...")
     
-    async with httpx.AsyncClient() as http_client:
+    async with contextlib.AsyncExitStack() as stack:
+        http_client = await stack.enter_async_context(httpx.AsyncClient())
         headers = {
             'apikey': config['supabase_key'],
             'Authorization': f"Bearer {config['supabase_key']}",
@@ -215,6 +224,8 @@ async def update_posts_with_ollama_json():
         
         updated_count = 0
         created_count = 0
+        sink = await create_sink(config, http_client, headers)
+        stack.push_async_callback(sink.close)
         for i, post in enumerate(posts):
             post_id = post['id']
             post_content = post['content']
@@ -236,12 +247,7 @@ async def update_posts_with_ollama_json():
                 first_event = sanitize_data(extracted_events[0])
                 try:
                     print_info(f"  Обновление основного поста ID: {post_id} в таблице posts...")
-                    update_response = await http_client.patch(
-                        f"{config['supabase_url']}/rest/v1/posts?id=eq.{post_id}",
-                        headers=headers,
-                        json=first_event
-                    )
-                    update_response.raise_for_status()
+                    await sink.update_post(post_id, first_event)
                     print_success(f"  Пост {post_id} успешно обновлен в posts.")
                     updated_count += 1
 
@@ -326,12 +332,7 @@ async def update_posts_with_ollama_json():
                         events_to_sync.append(event_extra)
                     
                     try:
-                        create_response = await http_client.post(
-                            f"{config['supabase_url']}/rest/v1/posts",
-                            headers=headers,
-                            json=additional_posts
-                        )
-                        create_response.raise_for_status()
+                        await sink.write_posts(additional_posts)
                         print_success(f"  Успешно создано {len(additional_posts)} дополнительных записей в posts.")
                         created_count += len(additional_posts)
                     except Exception as e:
@@ -342,18 +343,8 @@ async def update_posts_with_ollama_json():
                     try:
                         print_info(f"  Синхронизация {len(events_to_sync)} записей с таблицей events...")
                         
-                        # Разделяем на пачки с одинаковыми ключами (из-за поля image)
-                        ev_with_img = [e for e in events_to_sync if 'image' in e]
-                        ev_no_img = [e for e in events_to_sync if 'image' not in e]
-
-                        for ev_batch in [ev_with_img, ev_no_img]:
-                            if ev_batch:
-                                sync_response = await http_client.post(
-                                    f"{config['supabase_url']}/rest/v1/events",
-                                    headers=headers,
-                                    json=ev_batch
-                                )
-                                sync_response.raise_for_status()
+                        # Одна пачка; отсутствующее поле image получает значение по умолчанию из БД
+                        await sink.write_events(events_to_sync)
                         
                         print_success(f"  Таблица events успешно обновлена.")
                     except Exception as e:
@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+"""
+Прямая запись в Postgres (asyncpg) для больших исторических импортов.
+
+Вместо HTTP-запросов к PostgREST пачка уходит через пул соединений asyncpg одним
+вызовом ingest_channel_batch (sql/005_ingest_rpc.sql): слияние с posts и events
+выполняется на стороне базы — с той же дедупликацией и тем же обновлением чекпоинта,
+что и при записи через RPC. Включается переменными SINK=postgres и DATABASE_URL.
+
+Пакет asyncpg необязателен и нужен только для этого режима.
+"""
+
+import json
+from datetime import date
+from typing import Optional
+
+from sinks import Sink
+
+try:
+    import asyncpg
+except ImportError:
+    asyncpg = None
+
+_INGEST_SQL = 'SELECT public.ingest_channel_batch($1::jsonb)'
+
+
+def _quote_ident(name: str) -> str:
+    return '"' + name.replace('"', '""') + '"'
+
+
+def _parse_day(value) -> Optional[date]:
+    """YYYY-MM-DD -> date; None, если LLM вернула что-то другое (такой даты в events нет)."""
+    try:
+        return date.fromisoformat(str(value))
+    except ValueError:
+        return None
+
+
+class PostgresSink(Sink):
+    """Пул соединений asyncpg и операции записи/чтения, нужные импортеру."""
+
+    name = 'postgres'
+    transactional = True
+
+    def __init__(self, pool):
+        super().__init__()
+        self.pool = pool
+
+    @classmethod
+    async def connect(cls, dsn: str, min_size: int = 1, max_size: int = 4) -> 'PostgresSink':
+        if asyncpg is None:
+            raise RuntimeError("Для SINK=postgres нужен пакет asyncpg (pip install asyncpg)")
+        # statement_cache_size=0 — совместимость с pgbouncer в режиме transaction (пулер Supabase)
+        pool = await asyncpg.create_pool(dsn, min_size=min_size, max_size=max_size, statement_cache_size=0)
+        return cls(pool)
+
+    async def write_batch(self, posts: list, events: list, channel_states: list) -> dict:
+        """
+        Записывает пачку одним вызовом ingest_channel_batch (функция сама работает в транзакции).
+        channel_states — [{'id' или 'channel_name': ..., 'data': {...}}], как в RPC.
+        """
+        batch = {'posts': posts, 'events': events, 'channel_states': channel_states}
+        result = await self.pool.fetchval(_INGEST_SQL, json.dumps(batch, ensure_ascii=False))
+        return json.loads(result) if isinstance(result, str) else result
+
+    async def write_posts(self, rows: list):
+        await self.write_batch(rows, [], [])
+
+    async def write_events(self, rows: list):
+        await self.write_batch([], rows, [])
+
+    async def write_channel_state(self, match: dict, data: dict):
+        await self.write_batch([], [], [{**match, 'data': data}])
+
+    async def update_post(self, post_id, data: dict):
+        """UPDATE posts по id; значения приводятся к типам колонок через jsonb_populate_record."""
+        if not data:
+            return
+        assignments = ', '.join(f'{_quote_ident(c)} = r.{_quote_ident(c)}' for c in data)
+        await self.pool.execute(
+            f'UPDATE public.posts p SET {assignments} '
+            f'FROM jsonb_populate_record(NULL::public.posts, $2::jsonb) r WHERE p.id::text = $1',
+            str(post_id), json.dumps(data, ensure_ascii=False)
+        )
+
+    async def fetch_existing_event_keys(self, pairs) -> set:
+        """
+        Пары (title, whenDay), которые уже есть в events, — один запрос через unnest.
+        Сравнение идет по типу date, чтобы работал индекс по "whenDay".
+        """
+        pairs = list({(title, _parse_day(day)) for title, day in pairs if title and day})
+        pairs = [(title, day) for title, day in pairs if day is not None]
+        if not pairs:
+            return set()
+        rows = await self.pool.fetch(
+            """
+            SELECT e.title, e."whenDay"::text AS day
+            FROM public.events e
+            JOIN unnest($1::text[], $2::date[]) AS k(title, day)
+              ON e.title = k.title AND e."whenDay" = k.day
+            """,
+            [title for title, _ in pairs], [day for _, day in pairs]
+        )
+        return {(row['title'], row['day']) for row in rows}
+
+    async def fetch_upcoming_events(self, since: str) -> list:
+        """События с whenDay не раньше since (YYYY-MM-DD) для нечеткой дедупликации."""
+        rows = await self.pool.fetch(
+            'SELECT title, "whenDay"::text AS "whenDay", "where" FROM public.events WHERE "whenDay" >= $1::date',
+            date.fromisoformat(since)
+        )
+        return [dict(row) for row in rows]
+
+    def is_permanent_error(self, e: Exception) -> bool:
+        # Ошибки данных (22xxx) и ограничений (23xxx) повтором не исправить
+        if asyncpg is None or not isinstance(e, asyncpg.PostgresError):
+            return False
+        return (getattr(e, 'sqlstate', None) or '')[:2] in ('22', '23')
+
+    async def close(self):
+        await self.pool.close()
@@ -0,0 +1,317 @@
+#!/usr/bin/env python3
+"""
+Приемники данных импортера (sink).
+
+Все записи импортера и постобработки проходят через один интерфейс Sink:
+запись posts и events, обновление состояния канала (чекпоинт и статистика),
+обновление поста и чтение для дедупликации. Реализации:
+
+- SupabaseSink — REST API Supabase (PostgREST), по умолчанию;
+  при USE_INGEST_RPC=true пачка пишется одним вызовом ingest_channel_batch;
+- PostgresSink — напрямую в Postgres через asyncpg (scripts/pg_sink.py);
+- JsonlSink — строки в локальный JSONL-файл (прогоны без базы);
+- NullSink — ничего не пишет (замер этапов чтения и LLM без записи).
+
+Выбирается переменной SINK (supabase | postgres | jsonl | null).
+"""
+
+import json
+import os
+from abc import ABC, abstractmethod
+from datetime import datetime
+from typing import Optional
+from urllib.parse import quote
+
+import httpx
+
+DEFAULT_JSONL_PATH = os.path.join(os.path.dirname(__file__), 'state', 'sink.jsonl')
+
+# Естественные ключи для upsert (уникальные индексы из sql/004_natural_keys.sql)
+# title — в ключе: разные события одного сообщения в один день не должны схлопываться
+POSTS_CONFLICT_KEY = ('raw_channel_id', 'message_id', 'whenDay', 'title')
+EVENTS_CONFLICT_KEY = ('channel_name', 'message_id', 'whenDay', 'title')
+
+
+def dedupe_by_key(rows: list, key: tuple) -> list:
+    """Оставляет по одной (последней) записи на ключ: upsert не может затронуть строку дважды."""
+    unique = {}
+    for row in rows:
+        unique[tuple(row.get(k) for k in key)] = row
+    return list(unique.values())
+
+
+class Sink(ABC):
+    """
+    Интерфейс приемника. transactional=True означает, что write_batch пишет данные
+    и состояния каналов атомарно, и outbox отправляет группу одним вызовом.
+    """
+
+    name = 'sink'
+    transactional = False
+
+    def __init__(self):
+        self.write_seconds = 0.0  # суммарное время записи, считает flush_outbox
+
+    @abstractmethod
+    async def write_posts(self, rows: list):
+        ...
+
+    @abstractmethod
+    async def write_events(self, rows: list):
+        ...
+
+    @abstractmethod
+    async def write_channel_state(self, match: dict, data: dict):
+        """Обновляет строку channel_sync_state; match — {'id': ...} или {'channel_name': ...}."""
+
+    @abstractmethod
+    async def update_post(self, post_id, data: dict):
+        ...
+
+    async def write_batch(self, posts: list, events: list, channel_states: list):
+        """channel_states — [{'id' или 'channel_name': ..., 'data': {...}}]. Данные пишутся раньше состояний."""
+        if posts:
+            await self.write_posts(posts)
+        if events:
+            await self.write_events(events)
+        for entry in channel_states:
+            match = {k: v for k, v in entry.items() if k != 'data'}
+            await self.write_channel_state(match, entry['data'])
+
+    async def fetch_existing_event_keys(self, pairs) -> set:
+        """Пары (title, whenDay), которые уже есть в events."""
+        return set()
+
+    async def fetch_upcoming_events(self, since: str) -> list:
+        """События с whenDay не раньше since (поля title, whenDay, where)."""
+        return []
+
+    def is_permanent_error(self, e: Exception) -> bool:
+        """Ошибка, которую повтор не исправит (запись уходит в dead)."""
+        return False
+
+    async def close(self):
+        pass
+
+
+def _postgrest_quote(value) -> str:
+    """Значение для фильтров or=/and= PostgREST: в двойных кавычках с экранированием."""
+    return '"' + str(value).replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+
+def batch_insert_params(rows: list, conflict_key: Optional[tuple] = None) -> dict:
+    """
+    Параметры запроса для вставки пачки с разными наборами ключей.
+    Вместе с заголовком Prefer: missing=default PostgREST берет список колонок из columns=,
+    а отсутствующие в строке поля заполняет значениями по умолчанию (например, image).
+    """
+    columns = sorted(set().union(*(row.keys() for row in rows)))
+    params = {'columns': ','.join(columns)}
+    if conflict_key:
+        params['on_conflict'] = ','.join(conflict_key)
+    return params
+
+
+class SupabaseSink(Sink):
+    """Запись через REST API Supabase (PostgREST)."""
+
+    name = 'supabase'
+
+    def __init__(self, http_client, config: dict, headers: dict):
+        super().__init__()
+        self.http_client = http_client
+        self.base_url = f"{config['supabase_url']}/rest/v1"
+        self.headers = headers
+        self.use_rpc = config.get('use_ingest_rpc', False)
+        self.transactional = self.use_rpc
+
+    async def _upsert(self, table: str, rows: list, conflict_key: tuple, resolution: str):
+        """Одна пачка на таблицу, повторная вставка по естественному ключу — по resolution."""
+        batch = dedupe_by_key(rows, conflict_key)
+        resp = await self.http_client.post(
+            f"{self.base_url}/{table}",
+            params=batch_insert_params(batch, conflict_key),
+            headers={**self.headers, 'Prefer': f'resolution={resolution},missing=default'},
+            json=batch
+        )
+        resp.raise_for_status()
+
+    async def write_posts(self, rows: list):
+        # posts — служебный лог, повтор обновляет запись
+        await self._upsert('posts', rows, POSTS_CONFLICT_KEY, 'merge-duplicates')
+
+    async def write_events(self, rows: list):
+        # events могли отредактировать вручную — существующие не трогаем
+        await self._upsert('events', rows, EVENTS_CONFLICT_KEY, 'ignore-duplicates')
+
+    async def write_channel_state(self, match: dict, data: dict):
+        resp = await self.http_client.patch(
+            f"{self.base_url}/channel_sync_state",
+            params={k: f"eq.{v}" for k, v in match.items()},
+            headers=self.headers,
+            json=data
+        )
+        resp.raise_for_status()
+
+    async def update_post(self, post_id, data: dict):
+        resp = await self.http_client.patch(
+            f"{self.base_url}/posts",
+            params={'id': f"eq.{post_id}"},
+            headers=self.headers,
+            json=data
+        )
+        resp.raise_for_status()
+
+    async def write_batch(self, posts: list, events: list, channel_states: list):
+        if not self.use_rpc:
+            return await super().write_batch(posts, events, channel_states)
+        # Вся пачка — один запрос и одна транзакция (sql/005_ingest_rpc.sql)
+        resp = await self.http_client.post(
+            f"{self.base_url}/rpc/ingest_channel_batch",
+            headers=self.headers,
+            json={'payload': {
+                'posts': dedupe_by_key(posts, POSTS_CONFLICT_KEY),
+                'events': dedupe_by_key(events, EVENTS_CONFLICT_KEY),
+                'channel_states': channel_states
+            }}
+        )
+        resp.raise_for_status()
+
+    async def fetch_existing_event_keys(self, pairs) -> set:
+        """
+        Одна выборка на пачку (фильтр or=(and(...),...)) вместо запроса на каждое событие;
+        длинные пачки режутся, чтобы не упереться в лимит длины URL.
+        """
+        pairs = list({(title, day) for title, day in pairs if title and day})
+        existing = set()
+        if not pairs:
+            return existing
+
+        max_filter_len = 6000  # байт в URL после кодирования (кириллица — 6 байт на букву)
+        chunks, chunk, chunk_len = [], [], 0
+        for title, day in pairs:
+            condition = f"and(title.eq.{_postgrest_quote(title)},whenDay.eq.{day})"
+            condition_len = len(quote(condition)) + 3
+            if chunk and chunk_len + condition_len > max_filter_len:
+                chunks.append(chunk)
+                chunk, chunk_len = [], 0
+            chunk.append(condition)
+            chunk_len += condition_len
+        if chunk:
+            chunks.append(chunk)
+
+        for conditions in chunks:
+            resp = await self.http_client.get(
+                f"{self.base_url}/events",
+                params={'select': 'title,whenDay', 'or': f"({','.join(conditions)})"},
+                headers=self.headers
+            )
+            resp.raise_for_status()
+            existing.update((row['title'], row['whenDay']) for row in resp.json())
+        return existing
+
+    async def fetch_upcoming_events(self, since: str) -> list:
+        page_size = 1000  # max-rows PostgREST по умолчанию
+        rows, offset = [], 0
+        while True:
+            resp = await self.http_client.get(
+                f"{self.base_url}/events",
+                params={
+                    'select': 'title,whenDay,where',
+                    'whenDay': f'gte.{since}',
+                    'order': 'id',
+                    'limit': page_size,
+                    'offset': offset
+                },
+                headers=self.headers
+            )
+            resp.raise_for_status()
+            page = resp.json()
+            rows.extend(page)
+            if len(page) < page_size:
+                return rows
+            offset += page_size
+
+    def is_permanent_error(self, e: Exception) -> bool:
+        # 4xx (кроме таймаута и лимита) не исправится повтором
+        if isinstance(e, httpx.HTTPStatusError):
+            code = e.response.status_code
+            return 400 <= code < 500 and code not in (408, 429)
+        return False
+
+
+class JsonlSink(Sink):
+    """Дописывает все записи в JSONL-файл: одна строка на запись, поле table — куда она шла бы."""
+
+    name = 'jsonl'
+    transactional = True
+
+    def __init__(self, path: str = DEFAULT_JSONL_PATH):
+        super().__init__()
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+    def _append(self, records: list):
+        written_at = datetime.now().isoformat()
+        with open(self.path, 'a', encoding='utf-8') as f:
+            for record in records:
+                f.write(json.dumps({**record, 'written_at': written_at}, ensure_ascii=False, default=str) + '\n')
+
+    async def write_posts(self, rows: list):
+        self._append([{'table': 'posts', 'row': row} for row in rows])
+
+    async def write_events(self, rows: list):
+        self._append([{'table': 'events', 'row': row} for row in rows])
+
+    async def write_channel_state(self, match: dict, data: dict):
+        self._append([{'table': 'channel_sync_state', 'match': match, 'data': data}])
+
+    async def update_post(self, post_id, data: dict):
+        self._append([{'table': 'posts', 'match': {'id': post_id}, 'data': data}])
+
+    async def write_batch(self, posts: list, events: list, channel_states: list):
+        self._append(
+            [{'table': 'posts', 'row': row} for row in posts]
+            + [{'table': 'events', 'row': row} for row in events]
+            + [{'table': 'channel_sync_state', 'match': {k: v for k, v in s.items() if k != 'data'},
+                'data': s['data']} for s in channel_states]
+        )
+
+
+class NullSink(Sink):
+    """Ничего не пишет и ничего не находит."""
+
+    name = 'null'
+    transactional = True
+
+    async def write_posts(self, rows: list):
+        pass
+
+    async def write_events(self, rows: list):
+        pass
+
+    async def write_channel_state(self, match: dict, data: dict):
+        pass
+
+    async def update_post(self, post_id, data: dict):
+        pass
+
+    async def write_batch(self, posts: list, events: list, channel_states: list):
+        pass
+
+
+async def create_sink(config: dict, http_client, headers: dict) -> Sink:
+    """Создает приемник по config['sink']."""
+    kind = config.get('sink', 'supabase')
+    if kind == 'supabase':
+        return SupabaseSink(http_client, config, headers)
+    if kind == 'postgres':
+        from pg_sink import PostgresSink
+        if not config.get('database_url'):
+            raise RuntimeError("Для SINK=postgres нужна переменная DATABASE_URL")
+        return await PostgresSink.connect(config['database_url'])
+    if kind == 'jsonl':
+        return JsonlSink(config.get('sink_path') or DEFAULT_JSONL_PATH)
+    if kind == 'null':
+        return NullSink()
+    raise ValueError(f"Неизвестный SINK: {kind} (ожидается supabase, postgres, jsonl или null)")
@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+"""
+Очистка и нормализация текста сообщений.
+
+normalize_text приводит названия месяцев в верхнем регистре к нижнему перед
+отправкой в LLM. extract_links достает ссылки и юзернеймы из сущностей сообщения
+Telethon: форматирование Telegram хранит в msg.entities, а msg.raw_text — уже
+чистый текст, поэтому разметку из текста вырезать не нужно.
+Шаблоны компилируются один раз при импорте модуля. Результат normalize_text
+совпадает с прежней реализацией — проверка и замер скорости в scripts/bench_text_cleaner.py.
+"""
+
+import re
+
+from telethon.tl.types import MessageEntityMention, MessageEntityTextUrl, MessageEntityUrl
+
+# Месяцы в верхнем регистре -> нижний регистр
+MONTH_MAP = {
+    'ЯНВАРЯ': 'января', 'ФЕВРАЛЯ': 'февраля', 'МАРТА': 'марта',
+    'АПРЕЛЯ': 'апреля', 'МАЯ': 'мая', 'ИЮНЯ': 'июня',
+    'ИЮЛЯ': 'июля', 'АВГУСТА': 'августа', 'СЕНТЯБРЯ': 'сентября',
+    'ОКТЯБРЯ': 'октября', 'НОЯБРЯ': 'ноября', 'ДЕКАБРЯ': 'декабря'
+}
+MONTH_PATTERN = re.compile('|'.join(MONTH_MAP.keys()), re.IGNORECASE)
+
+# Поиск без IGNORECASE по тексту в нижнем регистре в несколько раз быстрее.
+# Исторические варианты букв (U+1C80–U+1C88) re.IGNORECASE считает равными в, д, о, с, т, ъ, ѣ —
+# приводим их так же, чтобы совпадения были теми же, что у MONTH_PATTERN.
+_LOWER_MONTH_PATTERN = re.compile('|'.join(MONTH_MAP.values()))
+_CYRILLIC_VARIANTS = str.maketrans('\u1c80\u1c81\u1c82\u1c83\u1c84\u1c85\u1c86\u1c87', 'вдосттъѣ')
+
+
+# t.me/<username> — ссылка на контакт, а не на сайт (t.me/c/..., t.me/+invite и посты не подходят)
+_TG_USERNAME_URL = re.compile(r'^(?:https?://)?(?:t\.me|telegram\.me)/([A-Za-z][A-Za-z0-9_]{3,31})/?$', re.IGNORECASE)
+
+
+def _replace_month(match) -> str:
+    return MONTH_MAP.get(match.group(0).upper(), match.group(0))
+
+
+def normalize_text(text: str) -> str:
+    """Приводит текст в более удобный для LLM формат."""
+    if not text:
+        return ""
+    lowered = text.lower().translate(_CYRILLIC_VARIANTS)
+    if len(lowered) != len(text):
+        # Редкие символы, которые при lower() меняют длину (например, İ): позиции не совпадут
+        return MONTH_PATTERN.sub(_replace_month, text)
+    parts, pos = [], 0
+    for match in _LOWER_MONTH_PATTERN.finditer(lowered):
+        parts.append(text[pos:match.start()])
+        parts.append(match.group(0))
+        pos = match.end()
+    if not parts:
+        return text
+    parts.append(text[pos:])
+    return ''.join(parts)
+
+
+def extract_links(entity_texts) -> tuple:
+    """
+    Ссылки и юзернеймы из сущностей сообщения — результата msg.get_entities_text()
+    (пары (сущность, текст) с уже пересчитанными смещениями UTF-16).
+    Возвращает (urls, usernames) без повторов, в порядке появления; юзернеймы без @.
+    Ссылки вида t.me/<username> попадают в юзернеймы.
+    """
+    urls, usernames = [], []
+    for entity, text in entity_texts:
+        if isinstance(entity, MessageEntityMention):
+            usernames.append(text.lstrip('@'))
+            continue
+        if isinstance(entity, MessageEntityTextUrl):
+            url = entity.url
+        elif isinstance(entity, MessageEntityUrl):
+            url = text
+        else:
+            continue
+        match = _TG_USERNAME_URL.match(url)
+        if match:
+            usernames.append(match.group(1))
+        elif '://' not in url:
+            urls.append(f"https://{url}")
+        elif url.lower().startswith(('http://', 'https://')):
+            urls.append(url)
+    return list(dict.fromkeys(urls)), list(dict.fromkeys(usernames))
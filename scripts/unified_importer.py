@@ -8,17 +8,30 @@ from telethon.sessions import StringSession
 import asyncio
 import os
 import json
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
 import httpx
 import sys
 import re
 from typing import Optional
 import logging
 import subprocess
-
-from telethon.tl.functions.channels import GetForumTopicsRequest
-from telethon.tl.types import InputChannel
-from urllib.parse import quote
+import socket
+import time
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
+
+from telethon.tl.functions.channels import GetForumTopicsRequest, GetFullChannelRequest
+from telethon.tl.functions.updates import GetChannelDifferenceRequest
+from telethon.tl.types import InputChannel, Channel, ChatPhotoEmpty, ChannelMessagesFilterEmpty, InputPhotoFileLocation
+from telethon.tl.types.updates import ChannelDifferenceEmpty, ChannelDifferenceTooLong
+from telethon import utils as tg_utils
+from telethon import errors as tg_errors
+
+from local_state import LocalState, DEFAULT_STATE_PATH
+from event_dedup import EventDedupIndex, FuzzyEventIndex
+from sinks import Sink, create_sink, POSTS_CONFLICT_KEY, EVENTS_CONFLICT_KEY
+from text_cleaner import normalize_text, extract_links
+from images import sha256_hex, content_path, dhash, process_image, IMAGE_FORMATS, HAS_PIL
 
 # Global logger instance
 logger = None
@@ -101,6 +114,38 @@ def load_config():
         'openrouter_api_key': os.getenv('OPENROUTER_API_KEY', '').strip(),
         'openrouter_model': os.getenv('OPENROUTER_MODEL', 'google/gemma-4-26b-a4b-it:free'),
         'use_openrouter': os.getenv('USE_OPENROUTER', 'false').lower() == 'true',
+        'state_db_path': os.getenv('IMPORTER_STATE_DB', DEFAULT_STATE_PATH),
+        'forum_topics_ttl': int(os.getenv('FORUM_TOPICS_TTL', '300')),  # секунд, 0 — без кэша
+        'journal_retention_days': int(os.getenv('JOURNAL_RETENTION_DAYS', '30')),
+        'llm_call_budget': int(os.getenv('LLM_CALL_BUDGET', '0')),  # вызовов LLM на запуск, 0 — без ограничения
+        'adaptive_polling': os.getenv('ADAPTIVE_POLLING', 'true').lower() == 'true',
+        'poll_min_interval': int(os.getenv('POLL_MIN_INTERVAL', '900')),  # секунд
+        'poll_max_staleness': int(os.getenv('POLL_MAX_STALENESS', '86400')),  # секунд
+        'channel_leases': os.getenv('CHANNEL_LEASES', 'false').lower() == 'true',
+        'worker_id': os.getenv('WORKER_ID') or f"{socket.gethostname()}:{os.getpid()}",
+        'lease_ttl': int(os.getenv('LEASE_TTL', '900')),  # секунд
+        'outbox_batch_size': int(os.getenv('OUTBOX_BATCH_SIZE', '500')),  # строк в одном запросе
+        'outbox_flush_interval': int(os.getenv('OUTBOX_FLUSH_INTERVAL', '15')),  # секунд
+        'outbox_requeue_dead': os.getenv('OUTBOX_REQUEUE_DEAD', 'false').lower() == 'true',  # вернуть dead в очередь при старте
+        'use_ingest_rpc': os.getenv('USE_INGEST_RPC', 'false').lower() == 'true',  # см. sql/005_ingest_rpc.sql
+        'sink': os.getenv('SINK', 'supabase').lower(),  # supabase | postgres | jsonl | null
+        'database_url': os.getenv('DATABASE_URL', ''),  # для SINK=postgres
+        'sink_path': os.getenv('SINK_PATH', ''),  # для SINK=jsonl
+        'image_dhash_distance': int(os.getenv('IMAGE_DHASH_DISTANCE', '0')),  # бит из 64, 0 — только точное совпадение
+        'media_concurrency': int(os.getenv('MEDIA_CONCURRENCY', '4')),  # одновременных скачиваний/загрузок фото
+        'media_prefetch': os.getenv('MEDIA_PREFETCH', 'true').lower() == 'true',  # скачивать фото, пока работает LLM
+        'media_streaming': os.getenv('MEDIA_STREAMING', 'false').lower() == 'true',  # фото из Telegram сразу в Storage, без буфера в памяти
+        'media_stream_buffer': int(os.getenv('MEDIA_STREAM_BUFFER', '4')),  # частей по 128 КБ на одну передачу
+        'photo_download_side': int(os.getenv('PHOTO_DOWNLOAD_SIDE', '1280')),  # пикселей, 0 — всегда оригинал
+        'image_max_side': int(os.getenv('IMAGE_MAX_SIDE', '1280')),  # пикселей, 0 — загружать оригинал
+        'image_format': os.getenv('IMAGE_FORMAT', 'webp').lower(),  # webp | jpeg
+        'image_quality': int(os.getenv('IMAGE_QUALITY', '80')),
+        'image_thumb_side': int(os.getenv('IMAGE_THUMB_SIDE', '0')),  # пикселей, 0 — без миниатюры
+        'image_workers': int(os.getenv('IMAGE_WORKERS', '2')),  # процессов для обработки фото
+        'dedup_match_time': os.getenv('DEDUP_MATCH_TIME', 'false').lower() == 'true',
+        'dedup_match_venue': os.getenv('DEDUP_MATCH_VENUE', 'false').lower() == 'true',
+        'fuzzy_dedup': os.getenv('FUZZY_DEDUP', 'true').lower() == 'true',
+        'dedup_similarity': float(os.getenv('DEDUP_SIMILARITY', '0.8')),  # 0..1, порог нечеткого совпадения
         'check_interval': 300  # 5 минут
     }
 
@@ -299,61 +344,9 @@ def sanitize_data(ollama_data: dict) -> dict:
     
     return ollama_data
 
-def clean_markdown_html(text: str) -> str:
-    """Очищает текст от Markdown и HTML тегов."""
-    if not text:
-        return ""
-    
-    # 1. HTML теги
-    text = re.sub(r'<[^>]+>', '', text)
-    
-    # 2. Markdown ссылки [текст](ссылка) -> текст
-    text = re.sub(r'\[([^\]]+)\]\([^\)]+\)', r'\1', text)
-    
-    # 3. Жирный/Курсив (простой вариант)
-    # ***text*** -> text (редкий кейс, но бывает)
-    text = re.sub(r'\*\*\*(.*?)\*\*\*', r'\1', text)
-    text = re.sub(r'___(.*?)___', r'\1', text)
-    # **text** -> text
-    text = re.sub(r'\*\*(.*?)\*\*', r'\1', text)
-    text = re.sub(r'__(.*?)__', r'\1', text)
-    # *text* -> text
-    text = re.sub(r'\*(.*?)\*', r'\1', text)
-    text = re.sub(r'_(.*?)_', r'\1', text)
-    
-    # 4. Моноширинный (код)
-    text = re.sub(r'`(.*?)`', r'\1', text)
-    text = re.sub(r'```(.*?)```', r'\1', text, flags=re.DOTALL)
-    
-    return text.strip()
-
-def normalize_text(text: str) -> str:
-    """Приводит текст в более удобный для LLM формат."""
-    if not text:
-        return ""
-    
-    # Словарь для замены месяцев в верхнем регистре на title case
-    month_map = {
-        'ЯНВАРЯ': 'января', 'ФЕВРАЛЯ': 'февраля', 'МАРТА': 'марта',
-        'АПРЕЛЯ': 'апреля', 'МАЯ': 'мая', 'ИЮНЯ': 'июня',
-        'ИЮЛЯ': 'июля', 'АВГУСТА': 'августа', 'СЕНТЯБРЯ': 'сентября',
-        'ОКТЯБРЯ': 'октября', 'НОЯБРЯ': 'ноября', 'ДЕКАБРЯ': 'декабря'
-    }
-    
-    # Заменяем месяцы, используя re.sub с функцией для независимости от регистра
-    def replace_month(match):
-        return month_map.get(match.group(0).upper(), match.group(0))
-
-    # Создаем паттерн (ЯНВАРЯ|ФЕВРАЛЯ|...|ДЕКАБРЯ)
-    month_pattern = re.compile('|'.join(month_map.keys()), re.IGNORECASE)
-    
-    text = month_pattern.sub(replace_month, text)
-    
-    return text
-
 # --- Whitelists for Supabase Tables ---
 ALLOWED_EVENT_FIELDS = {
-    'id', 'created_at', 'image', 'title', 'title_dop', 'description', 
+    'id', 'created_at', 'image', 'images', 'title', 'title_dop', 'description', 
     'whenDay', 'whenTime', 'link_site', 'price', 'where', 'author', 
     'link_map', 'link_contact', 'isAvailable', 'city', 'currency', 
     'isPriceFrom', 'category', 'isAuto', 'isOnline', 'author_username', 
@@ -363,7 +356,7 @@ ALLOWED_EVENT_FIELDS = {
 ALLOWED_POST_FIELDS = {
     'id', 'channel_name', 'message_id', 'content', 'posted_at', 
     'is_event_filtered', 'is_event', 'post_link', 'raw_channel_id', 
-    'image_url', 'created_at', 'image', 'title', 'title_dop', 
+    'image_url', 'created_at', 'image', 'images', 'title', 'title_dop', 
     'description', 'whenDay', 'whenTime', 'link_site', 'price', 
     'where', 'author', 'link_map', 'link_contact', 'isAvailable', 
     'city', 'currency', 'isPriceFrom', 'category', 'isOnline', 
@@ -374,24 +367,404 @@ def filter_fields(data: dict, allowed_fields: set) -> dict:
     """Removes keys that are not in the allowed_fields set."""
     return {k: v for k, v in data.items() if k in allowed_fields}
 
-async def check_event_exists_in_db(http_client, config, title, when_day, headers):
-    """Checks if an event with the same title and date already exists in Supabase."""
-    if not title or not when_day:
-        return False
-        
+async def load_fuzzy_event_index(sink: Sink, config: dict) -> Optional[FuzzyEventIndex]:
+    """
+    Загружает предстоящие события (whenDay >= сегодня) одной постраничной выборкой
+    и строит по ним нечеткий индекс. При ошибке возвращает None — тогда дубликаты
+    проверяются только точным запросом.
+    """
+    today = datetime.now().strftime('%Y-%m-%d')
+    index = FuzzyEventIndex(config['dedup_similarity'], since=today)
     try:
-        # Normalize title slightly if needed, but 'eq' is safest for now
-        encoded_title = quote(title)
-        # Using exact match for title and whenDay
-        url = f"{config['supabase_url']}/rest/v1/events?whenDay=eq.{when_day}&title=eq.{encoded_title}&select=id"
-        
-        resp = await http_client.get(url, headers=headers)
-        resp.raise_for_status()
-        data = resp.json()
-        return len(data) > 0
+        for row in await sink.fetch_upcoming_events(today):
+            index.add(row)
     except Exception as e:
-        print_error(f"    Ошибка при проверке дубликатов: {e}")
-        return False
+        print_error(f"Не удалось загрузить индекс событий для дедупликации: {e}")
+        return None
+    print_success(f"Индекс дедупликации: {len(index)} предстоящих событий.")
+    return index
+
+# --- Кэш сущностей каналов ---
+# Ошибки, после которых закэшированный access_hash считается недействительным
+ENTITY_CACHE_ERRORS = (
+    tg_errors.ChannelInvalidError,
+    tg_errors.ChannelPrivateError,
+    tg_errors.ChannelIdInvalidError,
+    tg_errors.PeerIdInvalidError,
+)
+
+def is_entity_cache_error(e: Exception) -> bool:
+    """
+    Ошибка из-за устаревшей записи кэша сущностей. ValueError учитывается только
+    с сообщением Telethon о ненайденной сущности: любая другая ValueError (например,
+    ошибка разбора) не должна сбрасывать кэш и вызывать повторный ResolveUsername.
+    """
+    if isinstance(e, ENTITY_CACHE_ERRORS):
+        return True
+    return isinstance(e, ValueError) and 'Could not find the input entity' in str(e)
+
+async def get_channel_entity(client, state: LocalState, peer):
+    """
+    client.get_entity с постоянным кэшем access_hash.
+
+    StringSession не сохраняет кэш сущностей Telethon между запусками, поэтому каждый
+    запуск заново резолвил каналы (а @username — через сильно лимитированный
+    ResolveUsername). Из кэша собирается объект Channel, которого достаточно для
+    get_messages и ссылок на посты; сеть не используется.
+    """
+    if isinstance(peer, int):
+        raw_id, _ = tg_utils.resolve_id(peer)
+        cached = state.get_cached_entity(channel_id=raw_id)
+    else:
+        cached = state.get_cached_entity(username=peer)
+
+    if cached is not None:
+        return Channel(
+            id=cached['channel_id'],
+            title=cached['title'] or '',
+            photo=ChatPhotoEmpty(),
+            date=None,
+            access_hash=cached['access_hash'],
+            username=cached['username'],
+            forum=bool(cached['is_forum'])
+        ), True
+
+    entity = await client.get_entity(peer)
+    if isinstance(entity, Channel) and entity.access_hash is not None and not entity.min:
+        state.save_entity(entity.id, entity.access_hash, entity.username, entity.title, bool(entity.forum))
+    return entity, False
+
+# --- Инкрементальная синхронизация (updates.getChannelDifference) ---
+async def check_channel_updates(client, entity, state: LocalState, thread_id: Optional[int] = None) -> tuple:
+    """
+    По сохраненному pts узнает, было ли новое в канале: (has_updates, new_pts).
+    new_pts сохраняется только после успешной обработки; при новых сообщениях кэш топиков сбрасывается.
+    """
+    input_channel = InputChannel(entity.id, entity.access_hash)
+    pts = state.get_channel_pts(entity.id, thread_id)
+
+    try:
+        if pts is None:
+            full = await client(GetFullChannelRequest(input_channel))
+            state.invalidate_forum_topics(entity.id)
+            return True, full.full_chat.pts
+
+        diff = await client(GetChannelDifferenceRequest(
+            channel=input_channel,
+            filter=ChannelMessagesFilterEmpty(),
+            pts=pts,
+            limit=100,
+            force=True
+        ))
+    except tg_errors.RPCError as e:
+        # Не смогли узнать — опрашиваем канал как раньше
+        print_info(f"  getChannelDifference недоступен ({e.__class__.__name__}), обычный опрос.")
+        state.invalidate_forum_topics(entity.id)
+        return True, None
+
+    if isinstance(diff, ChannelDifferenceEmpty):
+        return False, diff.pts
+    if isinstance(diff, ChannelDifferenceTooLong):
+        state.invalidate_forum_topics(entity.id)
+        return True, diff.dialog.pts
+    if diff.new_messages:
+        state.invalidate_forum_topics(entity.id)
+    return True, diff.pts
+
+# --- Топики форумов ---
+async def get_forum_topics(client, entity, state: LocalState, config: dict, last_id: int) -> tuple:
+    """
+    Возвращает ({topic_id: top_message}, complete) для форума.
+
+    Telegram отдает топики отсортированными по последней активности (закрепленные — первыми),
+    поэтому листаем страницы только до первого незакрепленного топика без сообщений новее
+    чекпоинта канала: все следующие за ним топики тоже "тихие". Для тихого форума это
+    один запрос. Результат кэшируется в локальном состоянии на FORUM_TOPICS_TTL секунд.
+    """
+    cached = state.get_forum_topics(entity.id, config['forum_topics_ttl'])
+    if cached is not None:
+        print_info(f"  Список топиков взят из кэша ({len(cached[0])} шт.)")
+        return cached
+
+    input_channel = InputChannel(entity.id, entity.access_hash)
+    page_size = 100
+    topics = {}
+    complete = True
+    offset_date, offset_id, offset_topic = 0, 0, 0
+
+    while True:
+        forum_topics = await client(GetForumTopicsRequest(
+            channel=input_channel,
+            offset_date=offset_date,
+            offset_id=offset_id,
+            offset_topic=offset_topic,
+            limit=page_size
+        ))
+
+        page = [t for t in forum_topics.topics if getattr(t, 'top_message', None) is not None]
+        reached_quiet = False
+        for topic in page:
+            topics[topic.id] = topic.top_message
+            if not getattr(topic, 'pinned', False) and topic.top_message <= last_id:
+                reached_quiet = True
+
+        if reached_quiet:
+            complete = False
+            break
+        if len(forum_topics.topics) < page_size or not page:
+            break
+
+        # Смещение для следующей страницы — по последнему топику текущей
+        last_topic = page[-1]
+        top_messages = {m.id: m for m in forum_topics.messages}
+        last_message = top_messages.get(last_topic.top_message)
+        offset_date = last_message.date if last_message else 0
+        offset_id = last_topic.top_message
+        offset_topic = last_topic.id
+
+    state.save_forum_topics(entity.id, topics, complete)
+    return topics, complete
+
+# --- Запись в базу (через outbox и sink) ---
+async def queue_posts_and_events(sink: Sink, state: LocalState, posts_to_insert: list,
+                                 journal_channel_id: Optional[int] = None, journal_message_ids: list = (),
+                                 dedup_index: Optional[EventDedupIndex] = None,
+                                 fuzzy_index: Optional[FuzzyEventIndex] = None) -> int:
+    """
+    Готовит записи для таблиц posts и events (с дедупликацией событий) и ставит их в outbox.
+    Отправкой в sink занимается flush_outbox. Сообщения журнала помечаются сохраненными
+    в той же транзакции SQLite. dedup_index — общий на запуск индекс уже принятых событий
+    (дубликаты между каналами), fuzzy_index — нечеткий индекс предстоящих событий из базы;
+    события вне его окна проверяются точным запросом. Возвращает число событий,
+    поставленных в очередь.
+    """
+    if dedup_index is None:
+        dedup_index = EventDedupIndex()
+    batch_index = EventDedupIndex(dedup_index.match_time, dedup_index.match_venue)
+
+    # 1. Таблица posts (лог)
+    # ЛОГИКА: если city == 1, в posts НЕ сохраняем
+    posts_for_log = [p for p in posts_to_insert if p.get('city') != 1]
+    if not posts_for_log:
+        print_info("  Пропуск вставки в 'posts' (все записи имеют city=1).")
+
+    # 2. Таблица events (всегда сохраняем валидные события)
+    events_to_insert = []
+    for p in posts_to_insert:
+        if p.get('is_event_filtered'):
+            event_entry = p.copy()
+            event_entry['isAuto'] = True
+            event_entry['author'] = '666408b4-1566-447b-a36c-0e36c9ebc96d'
+
+            if not event_entry.get('description') and p.get('content'):
+                event_entry['description'] = p.get('content')
+            if p.get('posted_at'):
+                event_entry['created_at'] = p.get('posted_at')
+            # Ссылка на пост — только если ни LLM, ни сущности сообщения ссылку не дали
+            if p.get('post_link') and not event_entry.get('link_site'):
+                event_entry['link_site'] = p.get('post_link')
+            if not event_entry.get('link_contact'):
+                event_entry['link_contact'] = p.get('author_username')
+
+            # Note: Manual popping of tech_fields is no longer strictly necessary 
+            # because of filter_fields, but we keep the logic clean.
+
+            # Если картинки нет — удаляем ключ (для дефолта БД)
+            if not event_entry.get('image'):
+                event_entry.pop('image', None)
+
+            # A. Локальная дедупликация: эта пачка и все события, принятые ранее в запуске
+            if event_entry in dedup_index or not batch_index.add(event_entry):
+                print_info(f"    ⚠️ Пропуск локального дубликата: {event_entry.get('title')} ({event_entry.get('whenDay')})")
+                continue
+
+            events_to_insert.append(event_entry)
+    accepted_events = list(events_to_insert)
+
+    # B. Нечеткая проверка по индексу предстоящих событий (без запросов к базе)
+    if fuzzy_index is not None:
+        unique_events = []
+        for e in events_to_insert:
+            similar = fuzzy_index.find(e) if fuzzy_index.covers(e.get('whenDay')) else None
+            if similar:
+                print_info(f"    ⚠️ Пропуск похожего события: {e.get('title')} ≈ {similar} ({e.get('whenDay')})")
+            else:
+                unique_events.append(e)
+        events_to_insert = unique_events
+
+    # C. Database Deduplication — одним запросом на всю пачку (только вне окна индекса)
+    unindexed = [e for e in events_to_insert
+                 if fuzzy_index is None or not fuzzy_index.covers(e.get('whenDay'))]
+    if unindexed:
+        try:
+            existing_keys = await sink.fetch_existing_event_keys(
+                [(e.get('title'), e.get('whenDay')) for e in unindexed]
+            )
+        except Exception as e:
+            print_error(f"    Ошибка при проверке дубликатов: {e}")
+            existing_keys = set()
+        if existing_keys:
+            for e in events_to_insert:
+                if (e.get('title'), e.get('whenDay')) in existing_keys:
+                    print_info(f"    ⚠️ Пропуск дубликата (найден в БД): {e.get('title')} ({e.get('whenDay')})")
+            events_to_insert = [e for e in events_to_insert if (e.get('title'), e.get('whenDay')) not in existing_keys]
+
+    # Канал в meta: по нему чекпоинт канала придерживается, пока его данные в dead
+    meta = {'channel_id': journal_channel_id} if journal_channel_id is not None else None
+    writes = []
+    if posts_for_log:
+        writes.append(('posts', [filter_fields(p, ALLOWED_POST_FIELDS) for p in posts_for_log], meta))
+    if events_to_insert:
+        writes.append(('events', [filter_fields(e, ALLOWED_EVENT_FIELDS) for e in events_to_insert], meta))
+    state.enqueue_writes(writes, journal_channel_id, journal_message_ids)
+    # В общий индекс попадают и события, найденные в БД, — их тоже больше не проверяем
+    for e in accepted_events:
+        dedup_index.add(e)
+    if fuzzy_index is not None:
+        for e in events_to_insert:
+            fuzzy_index.add(e)
+    print_success(f"  В очередь на запись: {len(posts_for_log)} в 'posts', {len(events_to_insert)} в 'events'.")
+    return len(events_to_insert)
+
+OUTBOX_LOCK = asyncio.Lock()
+
+def outbox_batch_payload(entries: list) -> dict:
+    """Группа outbox как аргументы Sink.write_batch (формат ingest_channel_batch)."""
+    return {
+        'posts': [row for e in entries if e['kind'] == 'posts' for row in e['payload']],
+        'events': [row for e in entries if e['kind'] == 'events' for row in e['payload']],
+        'channel_states': [
+            # Фильтр PostgREST {'id': 'eq.5'} -> {'id': '5'}
+            {**{k: v.removeprefix('eq.') for k, v in e['meta'].get('filter', e['meta']).items()}, 'data': e['payload']}
+            for e in entries if e['kind'] == 'channel_state'
+        ]
+    }
+
+def _take_outbox_group(pending: list, batch_size: int) -> list:
+    """Берет из начала очереди записи, пока не наберется batch_size строк данных."""
+    group, rows = [], 0
+    for entry in pending:
+        if entry['kind'] != 'channel_state':
+            if group and rows + len(entry['payload']) > batch_size:
+                break
+            rows += len(entry['payload'])
+        group.append(entry)
+    return group
+
+def _hold_back_states(state: LocalState, entries: list) -> list:
+    """Переводит в dead чекпоинты каналов, чьи данные лежат в dead, и возвращает остальные записи."""
+    dead_channels = state.outbox_dead_channels()
+    held = [e['id'] for e in entries
+            if e['kind'] == 'channel_state' and (e['meta'] or {}).get('channel_id') in dead_channels]
+    if held:
+        print_error(f"  Outbox: {len(held)} обновлений channel_sync_state отложено (status=dead) — данные канала не записаны.")
+        state.outbox_dead(held, 'отложено: данные канала в dead')
+    return [e for e in entries if e['id'] not in held]
+
+async def _send_with_retries(sink: Sink, send, state: LocalState, entries: list, label: str) -> Optional[str]:
+    """
+    send(entries) с повтором; при постоянной ошибке делит группу пополам, и в dead уходит только отвергнутая запись.
+    Возвращает None при успехе, 'dead', если часть записей ушла в dead, иначе текст ошибки.
+    """
+    ids = [e['id'] for e in entries]
+    error = None
+    for attempt in range(3):
+        try:
+            started = time.monotonic()
+            await send(entries)
+            sink.write_seconds += time.monotonic() - started
+            state.outbox_done(ids)
+            return None
+        except Exception as e:
+            if sink.is_permanent_error(e):
+                if len(entries) > 1:
+                    middle = len(entries) // 2
+                    first = await _send_with_retries(sink, send, state, entries[:middle], label)
+                    if first not in (None, 'dead'):
+                        return first
+                    rest = _hold_back_states(state, entries[middle:]) if first == 'dead' else entries[middle:]
+                    if not rest:
+                        return 'dead'
+                    second = await _send_with_retries(sink, send, state, rest, label)
+                    if second not in (None, 'dead'):
+                        return second
+                    return 'dead' if 'dead' in (first, second) else None
+                if isinstance(e, httpx.HTTPStatusError):
+                    details = f"{e.response.status_code}: {e.response.text[:500]}"
+                else:
+                    details = f"{e.__class__.__name__}: {e}"
+                print_error(f"  Outbox: постоянная ошибка записи {label} ({details}). Запись сохранена со статусом dead.")
+                state.outbox_dead(ids, details)
+                return 'dead'
+            error = str(e) or e.__class__.__name__
+            if attempt < 2:
+                await asyncio.sleep(2 ** attempt)
+
+    delay = min(60 * 2 ** entries[0]['attempts'], 3600)
+    state.outbox_retry(ids, error, delay)
+    print_error(f"  Outbox: ошибка записи {label}: {error}. Повтор через {delay} сек.")
+    return error
+
+async def flush_outbox(sink: Sink, state: LocalState, config: dict, force: bool = False) -> bool:
+    """
+    Отправляет outbox пачками: чекпоинты — после данных своего канала, ошибки — через _send_with_retries.
+    force=True (при старте) игнорирует next_attempt_at. Возвращает True, если очередь пуста.
+    """
+    async with OUTBOX_LOCK:
+        while True:
+            pending = state.outbox_pending()
+            if not pending:
+                return True
+            if not force and pending[0]['next_attempt_at'] > time.time():
+                return False
+
+            group = _take_outbox_group(pending, config['outbox_batch_size'])
+            group = _hold_back_states(state, group)
+            if not group:
+                continue
+            if sink.transactional:
+                error = await _send_with_retries(
+                    sink, lambda entries: sink.write_batch(**outbox_batch_payload(entries)),
+                    state, group, sink.name
+                )
+                if error is None:
+                    batch = outbox_batch_payload(group)
+                    print_success(f"  Outbox: записано {len(batch['posts'])} posts и "
+                                  f"{len(batch['events'])} events ({sink.name}).")
+                elif error != 'dead':
+                    return False
+                continue
+
+            data_entries = [e for e in group if e['kind'] != 'channel_state']
+            state_entries = [e for e in group if e['kind'] == 'channel_state']
+            if data_entries:
+                error = await _send_with_retries(
+                    sink, lambda entries: sink.write_batch(**{**outbox_batch_payload(entries), 'channel_states': []}),
+                    state, data_entries, 'posts/events'
+                )
+                if error is None:
+                    print_success(f"  Outbox: записано {sum(len(e['payload']) for e in data_entries)} строк в posts/events.")
+                elif error == 'dead':
+                    state_entries = _hold_back_states(state, state_entries)
+                else:
+                    return False
+
+            for entry in state_entries:
+                error = await _send_with_retries(
+                    sink, lambda entries: sink.write_batch([], [], outbox_batch_payload(entries)['channel_states']),
+                    state, [entry], 'channel_sync_state'
+                )
+                if error is not None and error != 'dead':
+                    return False
+
+async def run_outbox_flusher(sink: Sink, state: LocalState, config: dict):
+    """Фоновая задача: периодически отправляет outbox, пока идет обработка каналов."""
+    while True:
+        await asyncio.sleep(config['outbox_flush_interval'])
+        try:
+            await flush_outbox(sink, state, config)
+        except Exception as e:
+            print_error(f"  Outbox: ошибка фоновой отправки: {e}")
 
 # --- Взаимодействие с Gemini ---
 async def process_message_with_gemini(content: str, config: dict, prompt_template: str, message_date: datetime) -> Optional[dict]:
@@ -615,6 +988,498 @@ async def process_message_with_openrouter(content: str, config: dict, prompt_tem
         
         return None
 
+def get_llm_name(config: dict) -> str:
+    if config.get('use_ollama'):
+        return "Ollama"
+    if config.get('use_openrouter'):
+        return "OpenRouter"
+    return "Gemini"
+
+async def process_message_with_llm(content: str, config: dict, prompt_template: str, message_date: datetime):
+    """Отправляет сообщение в выбранную в конфигурации LLM."""
+    if config.get('use_ollama'):
+        return await process_message_with_ollama(content, config, prompt_template, message_date)
+    if config.get('use_openrouter'):
+        return await process_message_with_openrouter(content, config, prompt_template, message_date)
+    return await process_message_with_gemini(content, config, prompt_template, message_date)
+
+# --- Планировщик каналов ---
+def channel_priority(channel: dict, prior_events: float = 1.0, prior_calls: float = 2.0) -> float:
+    """
+    Ожидаемое число событий на один вызов LLM по статистике канала из channel_sync_state.
+    Сглаживание априорными значениями дает новым каналам (без статистики) достаточно
+    высокий приоритет, чтобы они успели набрать историю.
+    """
+    events = channel.get('stat_events_imported') or 0
+    llm_calls = channel.get('stat_llm_calls') or 0
+    return (events + prior_events) / (llm_calls + prior_calls)
+
+def channel_state_params(channel: dict) -> dict:
+    """Фильтр PostgREST для строки channel_sync_state (по id, если он есть)."""
+    if channel.get('id') is not None:
+        return {'id': f"eq.{channel['id']}"}
+    return {'channel_name': f"eq.{channel.get('channel_name')}"}
+
+def parse_timestamp(value) -> Optional[datetime]:
+    """Разбирает timestamptz из PostgREST (ISO 8601) в aware datetime."""
+    if not value:
+        return None
+    try:
+        parsed = datetime.fromisoformat(str(value).replace('Z', '+00:00'))
+    except ValueError:
+        return None
+    return parsed if parsed.tzinfo else parsed.replace(tzinfo=timezone.utc)
+
+def is_channel_due(channel: dict, now: datetime) -> bool:
+    # Небольшой допуск, чтобы канал, назначенный ровно на следующий запуск крона, не пропускал его
+    next_poll_at = parse_timestamp(channel.get('next_poll_at'))
+    return next_poll_at is None or next_poll_at <= now + timedelta(minutes=5)
+
+def schedule_next_poll(channel: dict, new_messages: int, now: datetime, config: dict, completed: bool = True) -> dict:
+    """
+    Обновляет оценку частоты сообщений канала (EWMA, сообщений в сутки) и назначает
+    next_poll_at: примерно через время, за которое ожидается одно новое сообщение,
+    но не реже POLL_MAX_STALENESS и не чаще POLL_MIN_INTERVAL.
+    Недообработанный канал (например, из-за бюджета LLM) опрашивается при следующем запуске.
+    """
+    alpha = 0.3
+    old_rate = channel.get('msg_rate_per_day')
+    last_polled_at = parse_timestamp(channel.get('last_polled_at'))
+
+    rate = old_rate
+    if last_polled_at is not None:
+        elapsed_days = max((now - last_polled_at).total_seconds() / 86400, 1 / 1440)
+        observed = new_messages / elapsed_days
+        rate = observed if old_rate is None else alpha * observed + (1 - alpha) * old_rate
+
+    if not completed:
+        next_poll_at = now
+    elif rate is None:
+        next_poll_at = now + timedelta(seconds=config['poll_min_interval'])
+    elif rate > 0:
+        interval = min(max(86400 / rate, config['poll_min_interval']), config['poll_max_staleness'])
+        next_poll_at = now + timedelta(seconds=interval)
+    else:
+        next_poll_at = now + timedelta(seconds=config['poll_max_staleness'])
+
+    return {
+        'msg_rate_per_day': rate,
+        'last_polled_at': now.isoformat(),
+        'next_poll_at': next_poll_at.isoformat()
+    }
+
+def update_channel_state(state: LocalState, channel: dict, data: dict, channel_id: int):
+    """Ставит PATCH строки channel_sync_state в outbox (после уже поставленных данных канала)."""
+    state.enqueue_writes([('channel_state', data, {'filter': channel_state_params(channel), 'channel_id': channel_id})])
+
+# --- Проверка миграций ---
+def uses_ingest_rpc(config: dict) -> bool:
+    """Запись идет через ingest_channel_batch (sql/005): RPC Supabase или SINK=postgres."""
+    return config['sink'] == 'postgres' or config['use_ingest_rpc']
+
+# Колонки channel_sync_state, которые импортер пишет при заданных настройках: (миграция, колонки, нужна ли).
+# UPDATE в ingest_channel_batch всегда пишет колонки 002, даже при ADAPTIVE_POLLING=false.
+CHANNEL_STATE_MIGRATIONS = (
+    ('sql/001_channel_stats.sql', ('stat_messages_seen', 'stat_llm_calls', 'stat_events_imported', 'last_activity_at'),
+     lambda config: True),
+    ('sql/002_channel_polling.sql', ('msg_rate_per_day', 'last_polled_at', 'next_poll_at'),
+     lambda config: config['adaptive_polling'] or uses_ingest_rpc(config)),
+    ('sql/003_channel_leases.sql', ('lease_owner', 'lease_expires_at'),
+     lambda config: config['channel_leases']),
+)
+
+async def find_missing_migrations(http_client, config, headers, channels: list) -> list:
+    """
+    Миграции sql/, без которых записи импортера будут отвергнуты базой (и уйдут в dead).
+    Колонки channel_sync_state видны по загруженным строкам, остальное проверяют пустые запросы.
+    """
+    base_url = f"{config['supabase_url']}/rest/v1"
+    missing = []
+    if channels:
+        for migration, columns, needed in CHANNEL_STATE_MIGRATIONS:
+            if needed(config) and any(column not in channels[0] for column in columns):
+                missing.append(migration)
+
+    # 004: upsert с on_conflict без уникального индекса — ошибка 42P10 даже для пустой пачки
+    for table, conflict_key in (('posts', POSTS_CONFLICT_KEY), ('events', EVENTS_CONFLICT_KEY)):
+        response = await http_client.post(
+            f"{base_url}/{table}",
+            params={'on_conflict': ','.join(conflict_key), 'columns': ','.join(conflict_key)},
+            headers={**headers, 'Prefer': 'resolution=ignore-duplicates,return=minimal'},
+            json=[]
+        )
+        if response.status_code == 400 and response.json().get('code') == '42P10':
+            missing.append('sql/004_natural_keys.sql')
+            break
+        response.raise_for_status()
+
+    if uses_ingest_rpc(config):
+        # Пустая пачка ничего не пишет; 404 — функции нет
+        response = await http_client.post(
+            f"{base_url}/rpc/ingest_channel_batch",
+            headers=headers,
+            json={'payload': {'posts': [], 'events': [], 'channel_states': []}}
+        )
+        if response.status_code == 404:
+            missing.append('sql/005_ingest_rpc.sql')
+        else:
+            response.raise_for_status()
+
+    for table in ('posts', 'events'):
+        response = await http_client.get(
+            f"{base_url}/{table}",
+            params={'select': 'images', 'limit': '0'},
+            headers=headers
+        )
+        if response.status_code == 400:
+            missing.append('sql/006_album_images.sql')
+            break
+        response.raise_for_status()
+    return missing
+
+# --- Аренда каналов (несколько процессов импортера) ---
+def _lease_filter(config: dict, now: datetime) -> str:
+    # Значения в кавычках: в имени хоста и во времени есть точки и двоеточия
+    return (f'(lease_owner.is.null,lease_expires_at.lt."{now.isoformat()}",'
+            f'lease_owner.eq."{config["worker_id"]}")')
+
+async def claim_channel_lease(http_client, config, headers, channel: dict) -> Optional[dict]:
+    """
+    Захватывает строку channel_sync_state условным PATCH: строка свободна, аренда истекла
+    или уже принадлежит этому воркеру. Атомарность обеспечивает Postgres (один UPDATE).
+    Возвращает свежую версию строки или None, если канал занят другим воркером.
+    """
+    now = datetime.now(timezone.utc)
+    response = await http_client.patch(
+        f"{config['supabase_url']}/rest/v1/channel_sync_state",
+        params={**channel_state_params(channel), 'or': _lease_filter(config, now)},
+        headers={**headers, 'Prefer': 'return=representation'},
+        json={
+            'lease_owner': config['worker_id'],
+            'lease_expires_at': (now + timedelta(seconds=config['lease_ttl'])).isoformat()
+        }
+    )
+    response.raise_for_status()
+    rows = response.json()
+    return rows[0] if rows else None
+
+async def renew_channel_lease(http_client, config, headers, channel: dict) -> bool:
+    now = datetime.now(timezone.utc)
+    response = await http_client.patch(
+        f"{config['supabase_url']}/rest/v1/channel_sync_state",
+        params={**channel_state_params(channel), 'lease_owner': f'eq.{config["worker_id"]}'},
+        headers={**headers, 'Prefer': 'return=representation'},
+        json={'lease_expires_at': (now + timedelta(seconds=config['lease_ttl'])).isoformat()}
+    )
+    return response.status_code < 300 and bool(response.json())
+
+async def keep_channel_lease(http_client, config, headers, channel: dict, lease_lost: asyncio.Event):
+    """
+    Фоновая задача: продлевает аренду, пока канал обрабатывается. Если аренду перехватили
+    или продлить ее не удавалось дольше LEASE_TTL, выставляет lease_lost — основной цикл
+    после этого не вызывает LLM и не пишет чекпоинты канала.
+    """
+    renewed_at = time.monotonic()
+    while True:
+        await asyncio.sleep(config['lease_ttl'] / 3)
+        try:
+            if not await renew_channel_lease(http_client, config, headers, channel):
+                print_error(f"  Аренда канала {channel.get('channel_name')} потеряна (перехвачена другим воркером?).")
+                lease_lost.set()
+                return
+            renewed_at = time.monotonic()
+        except Exception as e:
+            print_error(f"  Ошибка продления аренды: {e}")
+            if time.monotonic() - renewed_at >= config['lease_ttl']:
+                print_error(f"  Аренда канала {channel.get('channel_name')} истекла без продления.")
+                lease_lost.set()
+                return
+
+async def release_channel_lease(http_client, config, headers, channel: dict):
+    try:
+        await http_client.patch(
+            f"{config['supabase_url']}/rest/v1/channel_sync_state",
+            params={**channel_state_params(channel), 'lease_owner': f'eq.{config["worker_id"]}'},
+            headers=headers,
+            json={'lease_owner': None, 'lease_expires_at': None}
+        )
+    except Exception as e:
+        # Не страшно: аренда истечет сама через LEASE_TTL
+        print_error(f"  Не удалось освободить аренду канала: {e}")
+
+# --- Изображения ---
+def pick_photo_size(photo, target_side: int) -> Optional[str]:
+    """
+    Тип (PhotoSize.type) наименьшего размера фото, у которого большая сторона не меньше
+    target_side. None — качать оригинал (самый большой размер): target_side=0
+    или подходящего уменьшенного размера нет.
+    """
+    if target_side <= 0:
+        return None
+    candidates = [size for size in (photo.sizes or [])
+                  if getattr(size, 'w', None) and getattr(size, 'h', None)
+                  and max(size.w, size.h) >= target_side]
+    if not candidates:
+        return None
+    return min(candidates, key=lambda size: size.w * size.h).type
+
+async def fetch_message_photo(client, state: LocalState, msg, media_semaphore: asyncio.Semaphore,
+                              target_side: int = 0) -> tuple:
+    """
+    Скачивает фото сообщения — наименьший размер не меньше target_side (см. pick_photo_size).
+    Возвращает (url, None), если фото Telegram с таким id уже загружено, иначе (None, bytes).
+    Можно запускать фоном, пока работает LLM.
+    """
+    image_url = state.get_image_by_photo(msg.photo.id)
+    if image_url:
+        return image_url, None
+    thumb = pick_photo_size(msg.photo, target_side)
+    async with media_semaphore:
+        print_info(f"    Загрузка изображения из сообщения {msg.id} (размер: {thumb or 'оригинал'})...")
+        photo_bytes = await client.download_media(msg.photo, file=bytes, thumb=thumb)
+        if not photo_bytes and thumb is not None:
+            photo_bytes = await client.download_media(msg.photo, file=bytes)
+        return None, photo_bytes
+
+async def upload_message_photo(client, http_client, config: dict, state: LocalState, msg,
+                               media_semaphore: asyncio.Semaphore, prefetch=None,
+                               image_pool: Optional[ProcessPoolExecutor] = None) -> Optional[str]:
+    """
+    Загружает фото сообщения в Storage (путь — sha256 содержимого) и возвращает публичный URL или None.
+    prefetch — заранее запущенный fetch_message_photo; image_pool — уменьшение и перекодирование.
+    """
+    if prefetch is None and image_pool is None and config['media_streaming']:
+        return await stream_message_photo(client, http_client, config, state, msg, media_semaphore)
+    try:
+        image_url, photo_bytes = await (prefetch or fetch_message_photo(
+            client, state, msg, media_semaphore, config['photo_download_side']))
+    except Exception as e:
+        print_error(f"    Ошибка скачивания изображения из сообщения {msg.id}: {e}")
+        return None
+    if image_url:
+        print_info(f"    Изображение из сообщения {msg.id} уже загружено: {image_url}")
+        return image_url
+    if not photo_bytes:
+        return None
+
+    photo_id = msg.photo.id
+    sha256 = sha256_hex(photo_bytes)
+    image_url = state.get_image_by_hash(sha256)
+    if image_url:
+        state.link_photo(photo_id, sha256)
+        print_info(f"    Такое же изображение уже загружено: {image_url}")
+        return image_url
+
+    # Декодирование картинки (dHash, уменьшение) — вне цикла событий
+    loop = asyncio.get_event_loop()
+    variants = None
+    if image_pool is not None:
+        try:
+            variants = await loop.run_in_executor(
+                image_pool, process_image, photo_bytes, config['image_max_side'],
+                config['image_format'], config['image_quality'], config['image_thumb_side'])
+        except Exception as e:
+            print_error(f"    Ошибка обработки изображения, загружаем оригинал: {e}")
+
+    # dHash из пула сохраняется всегда (он бесплатный), поиск похожих — только по IMAGE_DHASH_DISTANCE
+    phash = variants['dhash'] if variants else None
+    if config['image_dhash_distance'] > 0:
+        if phash is None:
+            phash = await loop.run_in_executor(None, dhash, photo_bytes)
+        similar = state.find_similar_image(phash, config['image_dhash_distance'])
+        if similar:
+            state.save_image(sha256, similar[1], phash, photo_id)
+            print_info(f"    Похожее изображение уже загружено: {similar[1]}")
+            return similar[1]
+
+    if variants:
+        ext, content_type = IMAGE_FORMATS[config['image_format']]
+        uploads = [(content_path(sha256, ext), variants['image'])]
+        if variants['thumb']:
+            uploads.append((content_path(sha256, ext, suffix='_thumb'), variants['thumb']))
+    else:
+        content_type = 'image/jpeg'
+        uploads = [(content_path(sha256), photo_bytes)]
+
+    bucket_name = 'events'
+    storage_headers = {
+        'apikey': config['supabase_key'],
+        'Authorization': f"Bearer {config['supabase_key']}",
+        'Content-Type': content_type
+    }
+
+    try:
+        for file_path, content in uploads:
+            async with media_semaphore:
+                upload_response = await http_client.put(
+                    f"{config['supabase_url']}/storage/v1/object/{bucket_name}/{file_path}",
+                    headers=storage_headers, content=content)
+            upload_response.raise_for_status()
+        image_url = f"{config['supabase_url']}/storage/v1/object/public/{bucket_name}/{uploads[0][0]}"
+        state.save_image(sha256, image_url, phash, photo_id)
+        print_success(f"    Изображение успешно загружено ({len(photo_bytes) // 1024} → {len(uploads[0][1]) // 1024} КБ): {image_url}")
+        return image_url
+    except Exception as e:
+        print_error(f"    Ошибка загрузки изображения: {e}")
+        return None
+
+STREAM_CHUNK_SIZE = 128 * 1024  # request_size для iter_download: кратно 4 КБ, не больше 512 КБ
+
+async def stream_message_photo(client, http_client, config: dict, state: LocalState, msg,
+                               media_semaphore: asyncio.Semaphore) -> Optional[str]:
+    """Передает фото из Telegram в Storage потоком (tg/<photo_id>.jpg) и возвращает публичный URL или None."""
+    photo = msg.photo
+    image_url = state.get_image_by_photo(photo.id)
+    if image_url:
+        print_info(f"    Изображение из сообщения {msg.id} уже загружено: {image_url}")
+        return image_url
+
+    # Размер — как в fetch_message_photo, иначе самый большой
+    thumb = pick_photo_size(photo, config['photo_download_side'])
+    if thumb is None:
+        sizes = [size for size in photo.sizes if getattr(size, 'w', None) and getattr(size, 'h', None)]
+        if not sizes:
+            return None
+        thumb = max(sizes, key=lambda size: size.w * size.h).type
+    location = InputPhotoFileLocation(
+        id=photo.id, access_hash=photo.access_hash, file_reference=photo.file_reference, thumb_size=thumb)
+
+    buffer = asyncio.Queue(maxsize=max(1, config['media_stream_buffer']))
+    digest = hashlib.sha256()
+    transferred = 0
+
+    async def produce():
+        try:
+            async for chunk in client.iter_download(location, dc_id=photo.dc_id, request_size=STREAM_CHUNK_SIZE):
+                await buffer.put(chunk)
+            await buffer.put(None)
+        except Exception as e:
+            await buffer.put(e)
+
+    async def body():
+        nonlocal transferred
+        while True:
+            chunk = await buffer.get()
+            if chunk is None:
+                return
+            if isinstance(chunk, Exception):
+                raise chunk  # обрываем PUT: недокачанный файл не должен сохраниться
+            digest.update(chunk)
+            transferred += len(chunk)
+            yield chunk
+
+    bucket_name = 'events'
+    file_path = f"tg/{photo.id}.jpg"
+    storage_headers = {
+        'apikey': config['supabase_key'],
+        'Authorization': f"Bearer {config['supabase_key']}",
+        'Content-Type': 'image/jpeg'
+    }
+
+    async with media_semaphore:
+        print_info(f"    Потоковая загрузка изображения из сообщения {msg.id} (размер: {thumb})...")
+        producer = asyncio.create_task(produce())
+        try:
+            upload_response = await http_client.put(
+                f"{config['supabase_url']}/storage/v1/object/{bucket_name}/{file_path}",
+                headers=storage_headers, content=body())
+            upload_response.raise_for_status()
+        except Exception as e:
+            print_error(f"    Ошибка загрузки изображения: {e}")
+            return None
+        finally:
+            producer.cancel()
+
+    sha256 = digest.hexdigest()
+    uploaded_url = f"{config['supabase_url']}/storage/v1/object/public/{bucket_name}/{file_path}"
+    state.save_image(sha256, uploaded_url, None, photo.id)
+    image_url = state.get_image_by_hash(sha256)
+    if image_url != uploaded_url:
+        # Такое содержимое уже лежит в Storage под другим путем — копию не оставляем
+        print_info(f"    Такое же изображение уже загружено: {image_url}")
+        try:
+            async with media_semaphore:
+                delete_response = await http_client.delete(
+                    f"{config['supabase_url']}/storage/v1/object/{bucket_name}/{file_path}",
+                    headers=storage_headers)
+            delete_response.raise_for_status()
+        except Exception as e:
+            print_error(f"    Не удалось удалить повторную копию {file_path}: {e}")
+        return image_url
+    print_success(f"    Изображение успешно загружено ({transferred // 1024} КБ): {image_url}")
+    return image_url
+
+async def upload_message_photos(client, http_client, config: dict, state: LocalState, photo_messages: list,
+                                media_semaphore: asyncio.Semaphore, prefetch: Optional[dict] = None,
+                                image_pool: Optional[ProcessPoolExecutor] = None) -> list:
+    """
+    Загружает фото всех частей сообщения (альбома) параллельно.
+    prefetch — {message_id: задача fetch_message_photo}. Возвращает URL по порядку частей, без повторов.
+    """
+    prefetch = prefetch or {}
+    urls = await asyncio.gather(*(
+        upload_message_photo(client, http_client, config, state, part, media_semaphore, prefetch.get(part.id), image_pool)
+        for part in photo_messages
+    ))
+    return list(dict.fromkeys(url for url in urls if url))
+
+async def attach_pending_media(state: LocalState, channel_id: int, pending_media: list, journal_pending_ids: list):
+    """
+    Дожидается фоновых загрузок фото и дописывает URL в строки их сообщений,
+    после чего строки попадают в журнал. Вызывается перед записью пачки.
+    pending_media — [(message_id, rows, task)], задача возвращает список URL.
+    """
+    for message_id, rows, task in pending_media:
+        image_urls = await task
+        # Добавляем картинку только если она есть, чтобы сработал дефолт в БД;
+        # первое фото — обложка, images — весь альбом (sql/006_album_images.sql)
+        if image_urls:
+            for row in rows:
+                row['image'] = image_urls[0]
+                row['image_url'] = image_urls[0]
+                row['images'] = image_urls
+        state.journal_prepared(channel_id, message_id, rows)
+        journal_pending_ids.append(message_id)
+    pending_media.clear()
+
+def group_album_messages(messages) -> list:
+    """
+    Склеивает части альбома (сообщения с общим grouped_id) в одно логическое сообщение.
+    Возвращает [(msg, parts)] в порядке входного списка: msg — часть с подписью
+    (или первая часть), parts — все сообщения альбома; одиночное сообщение — ([msg]).
+    """
+    groups = []
+    albums = {}
+    for msg in messages:
+        grouped_id = getattr(msg, 'grouped_id', None)
+        if grouped_id is None:
+            groups.append([msg])
+        elif grouped_id in albums:
+            albums[grouped_id].append(msg)
+        else:
+            albums[grouped_id] = [msg]
+            groups.append(albums[grouped_id])
+    return [(next((part for part in parts if part.text), parts[0]), parts) for parts in groups]
+
+# --- Журнал обработки сообщений ---
+async def replay_message_journal(sink: Sink, state: LocalState,
+                                 dedup_index: Optional[EventDedupIndex] = None,
+                                 fuzzy_index: Optional[FuzzyEventIndex] = None):
+    """Ставит в outbox записи из журнала, не дошедшие до базы в прошлых запусках."""
+    pending = state.get_prepared_journal()
+    if not pending:
+        return
+
+    for channel_id, entries in pending.items():
+        rows = [row for _, message_rows in entries for row in message_rows]
+        print_info(f"Журнал: дозапись {len(rows)} записей из {len(entries)} сообщений канала {channel_id}...")
+        try:
+            await queue_posts_and_events(sink, state, rows,
+                                         channel_id, [message_id for message_id, _ in entries],
+                                         dedup_index, fuzzy_index)
+        except Exception as e:
+            print_error(f"Журнал: ошибка дозаписи для канала {channel_id}: {e}")
+
 # --- Основная логика импорта ---
 async def import_and_process_messages():
     """Основная функция импорта и обработки сообщений"""
@@ -626,6 +1491,12 @@ async def import_and_process_messages():
     if not prompt_template:
         return None
 
+    state = LocalState.open_exclusive(config['state_db_path'])
+    if state.path != config['state_db_path']:
+        print_info(f"Файл состояния занят другим воркером, используется {state.path}")
+    sink = None
+    image_pool = None
+
     print_info("Подключение к Telegram...")
     client = TelegramClient(
         StringSession(config['session_string']),
@@ -651,6 +1522,9 @@ async def import_and_process_messages():
                 'Content-Type': 'application/json'
             }
 
+            sink = await create_sink(config, http_client, headers)
+            print_success(f"Приемник данных: {sink.name} (SINK).")
+
             print_info("Получение списка каналов для синхронизации...")
             response = await http_client.get(
                 f"{config['supabase_url']}/rest/v1/channel_sync_state?select=*",
@@ -659,6 +1533,43 @@ async def import_and_process_messages():
             response.raise_for_status()
             channels = response.json()
             print_success(f"Найдено {len(channels)} каналов для синхронизации")
+
+            if sink.name in ('supabase', 'postgres'):
+                missing_migrations = await find_missing_migrations(http_client, config, headers, channels)
+                if missing_migrations:
+                    print_error(f"В базе не применены миграции: {', '.join(missing_migrations)}. "
+                                f"Примените их (или выключите ADAPTIVE_POLLING / CHANNEL_LEASES) и запустите импорт снова.")
+                    return None
+
+            # Сначала дозаписываем то, что осталось в журнале и outbox после прошлых сбоев
+            # Индекс принятых событий общий на весь запуск: дубликаты между каналами
+            dedup_index = EventDedupIndex(config['dedup_match_time'], config['dedup_match_venue'])
+            fuzzy_index = None
+            if config['fuzzy_dedup']:
+                fuzzy_index = await load_fuzzy_event_index(sink, config)
+
+            state.prune_journal(config['journal_retention_days'])
+            await replay_message_journal(sink, state, dedup_index, fuzzy_index)
+            if config['outbox_requeue_dead']:
+                requeued = state.outbox_requeue_dead()
+                if requeued:
+                    print_info(f"Outbox: {requeued} записей со статусом dead возвращены в очередь (OUTBOX_REQUEUE_DEAD).")
+            if not await flush_outbox(sink, state, config, force=True):
+                print_error("Outbox не удалось отправить полностью, записи остаются в очереди.")
+            outbox_task = asyncio.create_task(run_outbox_flusher(sink, state, config))
+            media_semaphore = asyncio.Semaphore(max(1, config['media_concurrency']))
+            # Уменьшение и перекодирование фото — в отдельных процессах, чтобы не блокировать цикл событий
+            if config['image_max_side'] > 0 and HAS_PIL:
+                image_pool = ProcessPoolExecutor(max_workers=max(1, config['image_workers']))
+                if config['media_streaming']:
+                    print_error("MEDIA_STREAMING=true не действует: включена обработка фото (IMAGE_MAX_SIDE). "
+                                "Для потоковой передачи задайте IMAGE_MAX_SIDE=0.")
+            elif config['image_max_side'] > 0:
+                print_info("Pillow не установлен: фото загружаются без уменьшения (IMAGE_MAX_SIDE).")
+
+            # Сначала каналы с наибольшим выходом событий на вызов LLM
+            channels.sort(key=channel_priority, reverse=True)
+            llm_calls_used = 0
             
             total_synced = 0
             total_messages_processed = 0
@@ -666,12 +1577,46 @@ async def import_and_process_messages():
             
             for channel in channels:
                 channel_name = channel.get('channel_name', str(channel['channel_id']))
+                if config['llm_call_budget'] and llm_calls_used >= config['llm_call_budget']:
+                    print_info(f"Бюджет вызовов LLM ({config['llm_call_budget']}) исчерпан. Оставшиеся каналы — в следующем запуске.")
+                    break
+
+                poll_started_at = datetime.now(timezone.utc)
+                if config['adaptive_polling'] and not is_channel_due(channel, poll_started_at):
+                    print_info(f"Канал {channel_name} пропущен: следующий опрос в {channel.get('next_poll_at')}.")
+                    continue
+
+                lease_task = None
+                lease_lost = asyncio.Event()
+                if config['channel_leases']:
+                    try:
+                        claimed = await claim_channel_lease(http_client, config, headers, channel)
+                    except Exception as e:
+                        print_error(f"Не удалось захватить канал {channel_name}: {e}")
+                        continue
+                    if claimed is None:
+                        print_info(f"Канал {channel_name} обрабатывается другим воркером.")
+                        continue
+                    # Строка могла измениться после чтения списка (чекпоинт, next_poll_at)
+                    channel = claimed
+                    if config['adaptive_polling'] and not is_channel_due(channel, poll_started_at):
+                        await release_channel_lease(http_client, config, headers, channel)
+                        continue
+                    lease_task = asyncio.create_task(keep_channel_lease(http_client, config, headers, channel, lease_lost))
+
                 print_header()
                 print_info(f"Обработка канала: {channel_name}")
                 
                 try:
                     posts_to_insert = []  # Initialize the list to collect posts for insertion - moved to start of channel processing for safety
+                    journal_pending_ids = []  # ID сообщений, чьи записи лежат в posts_to_insert
+                    pending_media = []  # фоновые загрузки фото: (message_id, rows, task)
+                    channel_messages_seen = 0
+                    channel_llm_calls = 0
+                    channel_events = 0
+                    channel_last_activity = None
                     entity = None # Initialize entity to None
+                    entity_from_cache = False
                     channel_id_from_db = channel.get('channel_id')
                     channel_name_lookup = channel.get('channel_name', '').strip()
 
@@ -680,15 +1625,15 @@ async def import_and_process_messages():
                     if channel_id_from_db is not None:
                         try:
                             channel_id = int(channel_id_from_db)
-                            entity = await client.get_entity(channel_id)
+                            entity, entity_from_cache = await get_channel_entity(client, state, channel_id)
                         except ValueError:
                             # Fallback to channel_name if numeric ID fails
                             if channel_name_lookup and channel_name_lookup.startswith('@'):
                                 print_info(f"  Попытка получить канал по имени (после ошибки ID): {channel_name_lookup}")
-                                entity = await client.get_entity(channel_name_lookup)
+                                entity, entity_from_cache = await get_channel_entity(client, state, channel_name_lookup)
                     elif channel_name_lookup and channel_name_lookup.startswith('@'):
                         print_info(f"  Попытка получить канал по имени (без ID): {channel_name_lookup}")
-                        entity = await client.get_entity(channel_name_lookup)
+                        entity, entity_from_cache = await get_channel_entity(client, state, channel_name_lookup)
                         
                         # Автоматическое обновление channel_id, если он был найден
                         if entity:
@@ -722,6 +1667,15 @@ async def import_and_process_messages():
                     
                     # Определение last_id
                     last_id = channel.get('last_processed_message_id', 0) or 0
+
+                    # Быстрая проверка: были ли вообще обновления в канале с прошлого запуска
+                    has_updates, new_pts = await check_channel_updates(client, entity, state, channel.get('thread_id'))
+                    if not has_updates:
+                        print_info(f"  Нет обновлений в канале (getChannelDifference, pts={new_pts}).")
+                        if config['adaptive_polling']:
+                            update_channel_state(state, channel, schedule_next_poll(channel, 0, poll_started_at, config), entity.id)
+                        continue
+                    channel_completed = True
                     
                     # Определение списка ID топиков для обработки
                     thread_ids_to_process = []
@@ -732,28 +1686,30 @@ async def import_and_process_messages():
                         print_info(f"  Синхронизация конкретного топика ID={specific_thread_id}")
                     elif hasattr(entity, 'forum') and entity.forum:
                         print_info(f"  Обнаружен форум. Получение списка топиков...")
-                        
-                        input_channel = InputChannel(entity.id, entity.access_hash)
-                        
-                        forum_topics = await client(GetForumTopicsRequest(
-                            channel=input_channel,
-                            offset_date=0,
-                            offset_id=0,
-                            offset_topic=0,
-                            limit=100
-                        ))
 
                         # ID топика — это ID его корневого сервисного сообщения
-                        new_thread_ids = [topic.id for topic in forum_topics.topics if topic.id != 1]
-                        thread_ids_to_process.extend([1] + new_thread_ids)
-                        
-                        print_success(f"  Найдено топиков: {len(thread_ids_to_process)}")
+                        topics, topics_complete = await get_forum_topics(client, entity, state, config, last_id)
+                        if 1 not in topics and topics_complete:
+                            topics[1] = None  # Общий топик без top_message — всегда опрашиваем
+
+                        skipped_topics = 0
+                        for topic_id, top_message in sorted(topics.items()):
+                            # Только собственный чекпоинт топика: канальный могли сдвинуть другие топики
+                            topic_checkpoint = state.get_topic_checkpoint(entity.id, topic_id) or last_id
+                            if top_message is not None and top_message <= topic_checkpoint:
+                                skipped_topics += 1
+                                continue
+                            thread_ids_to_process.append(topic_id)
+
+                        print_success(f"  Топиков с новыми сообщениями: {len(thread_ids_to_process)} (без изменений: {skipped_topics})")
                     else:
                         thread_ids_to_process.append(None)
 
                     # Обходим все топики
                     max_id_overall = last_id
-                    
+                    # Первое необработанное сообщение (бюджет LLM или ошибка LLM) — дальше канал не идёт
+                    stop_before_id = None
+
                     for thread_id in thread_ids_to_process:
                         if thread_id is None:
                             topic_label = "Основной канал"
@@ -767,19 +1723,25 @@ async def import_and_process_messages():
 
                         print_info(f"  > Синхронизация: {topic_label}")
 
+                        # У топика свой чекпоинт; канальный (максимум по всем топикам) — только для нового топика
+                        topic_min_id = last_id
+                        if thread_id_param is not None:
+                            topic_min_id = state.get_topic_checkpoint(entity.id, thread_id_param) or last_id
+                        topic_max_id = topic_min_id
+
                         # Получаем сообщения для ЭТОГО топика
                         # Если thread_id_param None, не передаем этот параметр вообще
                         if thread_id_param is None:
                             current_messages = await client.get_messages(
                                 entity,
                                 limit=50, # Increased limit to 50 to match original unified_importer.py
-                                min_id=last_id
+                                min_id=topic_min_id
                             )
                         else:
                             current_messages = await client.get_messages(
                                 entity,
                                 limit=50, # Increased limit to 50 to match original unified_importer.py
-                                min_id=last_id,
+                                min_id=topic_min_id,
                                 reply_to=thread_id_param
                             )
                         
@@ -789,31 +1751,68 @@ async def import_and_process_messages():
                             
                         print_success(f"  Найдено {len(current_messages)} новых сообщений в {topic_label}.")
                         
-                        for msg in reversed(current_messages): # Обрабатываем в хронологическом порядке
+                        # Обрабатываем в хронологическом порядке; альбом — одно сообщение с подписью и всеми фото
+                        for msg, album_parts in group_album_messages(reversed(current_messages)):
+                            channel_messages_seen += len(album_parts)
+                            last_part_id = max(part.id for part in album_parts)
+                            if channel_last_activity is None or msg.date > channel_last_activity:
+                                channel_last_activity = msg.date
+
                             if not msg.text:
-                                total_messages_processed += 1
-                                max_id_overall = max(max_id_overall, msg.id)
+                                total_messages_processed += len(album_parts)
+                                max_id_overall = max(max_id_overall, last_part_id)
+                                topic_max_id = max(topic_max_id, last_part_id)
+                                continue
+
+                            # Журнал: уже обработанные сообщения не отправляем в LLM повторно
+                            journal_entry = state.get_journal_entry(entity.id, msg.id)
+                            if journal_entry and journal_entry['status'] != 'extracted':
+                                print_info(f"  Сообщение {msg.id} уже обработано (журнал: {journal_entry['status']}).")
+                                total_messages_processed += len(album_parts)
+                                max_id_overall = max(max_id_overall, last_part_id)
+                                topic_max_id = max(topic_max_id, last_part_id)
                                 continue
 
-                            if config.get('use_ollama'):
-                                ollama_data = await process_message_with_ollama(msg.text, config, prompt_template, msg.date)
-                            elif config.get('use_openrouter'):
-                                ollama_data = await process_message_with_openrouter(msg.text, config, prompt_template, msg.date)
+                            photo_messages = [part for part in album_parts if part.photo]
+                            if len(album_parts) > 1:
+                                print_info(f"  Сообщение {msg.id} — альбом из {len(album_parts)} частей ({len(photo_messages)} фото).")
+                            photo_prefetch = {}
+                            if journal_entry:
+                                print_info(f"  Ответ LLM для сообщения {msg.id} взят из журнала.")
+                                ollama_data = journal_entry['extraction']
                             else:
-                                ollama_data = await process_message_with_gemini(msg.text, config, prompt_template, msg.date)
+                                if lease_lost.is_set():
+                                    print_error("  Аренда канала потеряна: обработка остановлена, остальные сообщения — другому воркеру.")
+                                    channel_completed = False
+                                    stop_before_id = min(part.id for part in album_parts)
+                                    break
+                                if config['llm_call_budget'] and llm_calls_used >= config['llm_call_budget']:
+                                    print_info("  Бюджет вызовов LLM на запуск исчерпан, остальные сообщения — в следующем запуске.")
+                                    channel_completed = False
+                                    stop_before_id = min(part.id for part in album_parts)
+                                    break
+                                # Фото скачиваются параллельно с запросом к LLM (в потоковом режиме — после ответа)
+                                if config['media_prefetch'] and not (config['media_streaming'] and image_pool is None):
+                                    photo_prefetch = {part.id: asyncio.create_task(fetch_message_photo(
+                                        client, state, part, media_semaphore, config['photo_download_side']))
+                                        for part in photo_messages}
+                                ollama_data = await process_message_with_llm(msg.text, config, prompt_template, msg.date)
+                                llm_calls_used += 1
+                                channel_llm_calls += 1
+                                if ollama_data is not None:
+                                    state.journal_extraction(entity.id, msg.id, ollama_data)
                             
                             if ollama_data is None:
-                                if config.get('use_ollama'):
-                                    error_source = "Ollama"
-                                elif config.get('use_openrouter'):
-                                    error_source = "OpenRouter"
-                                else:
-                                    error_source = "Gemini"
-                                print_error(f"  🛑 Пропуск сообщения {msg.id} и остановка из-за ошибки {error_source}.")
-                                break # Прекращаем обработку этого топика, чтобы не "проглотить" сообщения
+                                for task in photo_prefetch.values():
+                                    task.cancel()
+                                print_error(f"  🛑 Пропуск сообщения {msg.id} и остановка из-за ошибки {get_llm_name(config)}.")
+                                channel_completed = False
+                                stop_before_id = min(part.id for part in album_parts)
+                                break # Прекращаем обработку канала, чтобы не "проглотить" сообщения
 
-                            total_messages_processed += 1
-                            max_id_overall = max(max_id_overall, msg.id)
+                            total_messages_processed += len(album_parts)
+                            max_id_overall = max(max_id_overall, last_part_id)
+                            topic_max_id = max(topic_max_id, last_part_id)
 
                             # --- Поддержка массива объектов или одиночного объекта ---
                             results_to_process = []
@@ -822,226 +1821,186 @@ async def import_and_process_messages():
                             elif isinstance(ollama_data, dict):
                                 results_to_process = [ollama_data]
                             
-                            for item in results_to_process:
-                                # Событие, если есть флаг is_event ИЛИ если есть хотя бы дата и заголовок (иногда нейронка забывает флаг в массиве)
-                                is_actually_event = item.get('is_event') or (item.get('whenDay') and item.get('title'))
-                                
-                                if item and is_actually_event:
-                                    # Очистка и подготовка данных
-                                    cleaned_data = sanitize_data(item)
-
-                                    # Проверяем, является ли событие валидным (существует дата whenDay)
-                                    when_day = cleaned_data.get('whenDay')
-                                    original_is_event = True
-                                    if when_day is None:
-                                        print_info(f"  Сообщение {msg.id} - отсутствует дата события (whenDay пустое).")
-                                        cleaned_data['is_event'] = False
-                                        original_is_event = False
-                                    else:
-                                        total_events_imported += 1
-
-                                    image_url = None
-                                    if msg.photo:
-                                        print_info(f"    Загрузка изображения из сообщения {msg.id}...")
-                                        photo_bytes = await client.download_media(msg.photo, file=bytes)
-                                        if photo_bytes:
-                                            bucket_name = 'events'
-                                            current_date = datetime.now().strftime('%Y-%m-%d')
-                                            file_path = f"{current_date}/{entity.id}/{msg.id}.jpg"
-                                            storage_url = f"{config['supabase_url']}/storage/v1/object/{bucket_name}/{file_path}"
-                                            storage_headers = {
-                                                'apikey': config['supabase_key'],
-                                                'Authorization': f"Bearer {config['supabase_key']}",
-                                                'Content-Type': 'image/jpeg'
-                                            }
-                                            
-                                            try:
-                                                upload_response = await http_client.put(storage_url, headers=storage_headers, content=photo_bytes)
-                                                upload_response.raise_for_status()
-                                                image_url = f"{config['supabase_url']}/storage/v1/object/public/{bucket_name}/{file_path}"
-                                                print_success(f"    Изображение успешно загружено: {image_url}")
-                                            except Exception as e:
-                                                print_error(f"    Ошибка загрузки изображения: {e}")
-
-                                    if hasattr(entity, 'username') and entity.username:
-                                        base_link = f"https://t.me/{entity.username}"
-                                    else:
-                                        base_link = f"https://t.me/c/{abs(entity.id)}"
+                            msg_rows_start = len(posts_to_insert)
+                            # Текст без разметки и ссылки — из raw_text и сущностей сообщения, без разбора Markdown
+                            message_text = msg.raw_text.strip()
+                            message_urls, message_usernames = extract_links(msg.get_entities_text())
+                            # Событие, если есть флаг is_event ИЛИ если есть хотя бы дата и заголовок (иногда нейронка забывает флаг в массиве)
+                            event_items = [item for item in results_to_process
+                                           if item and (item.get('is_event') or (item.get('whenDay') and item.get('title')))]
+
+                            # Фото сообщения (все фото альбома) скачиваем и загружаем один раз для всех его событий.
+                            # Загрузка идет фоном, URL дописываются в строки перед записью (attach_pending_media)
+                            media_task = None
+                            if photo_messages and event_items:
+                                media_task = asyncio.create_task(upload_message_photos(
+                                    client, http_client, config, state, photo_messages, media_semaphore, photo_prefetch, image_pool))
+                            else:
+                                for task in photo_prefetch.values():
+                                    task.cancel()
+
+                            for item in event_items:
+                                # Очистка и подготовка данных
+                                cleaned_data = sanitize_data(item)
+
+                                # Проверяем, является ли событие валидным (существует дата whenDay)
+                                when_day = cleaned_data.get('whenDay')
+                                original_is_event = True
+                                if when_day is None:
+                                    print_info(f"  Сообщение {msg.id} - отсутствует дата события (whenDay пустое).")
+                                    cleaned_data['is_event'] = False
+                                    original_is_event = False
+                                else:
+                                    total_events_imported += 1
+                                    channel_events += 1
 
-                                    if thread_id_param is not None and thread_id_param != 1:
-                                        post_link = f"{base_link}/{thread_id_param}/{msg.id}"
-                                    else:
-                                        post_link = f"{base_link}/{msg.id}"
-
-                                    author_username = ""
-                                    author_link = ""
-                                    if msg.sender:
-                                        if hasattr(msg.sender, 'username') and msg.sender.username:
-                                            author_username = msg.sender.username
-                                            author_link = f"https://t.me/{msg.sender.username}"
-                                        elif hasattr(msg.sender, 'id'):
-                                            author_username = f"user_{msg.sender.id}"
-                                            author_link = ""
-
-                                    # Собираем финальный объект для вставки
-                                    cleaned_text = clean_markdown_html(msg.text)
-                                    final_post_data = {
-                                        **cleaned_data,
-                                        'channel_name': f"@{entity.username}" if hasattr(entity, 'username') and entity.username else f"channel_{entity.id}",
-                                        'message_id': msg.id,
-                                        'content': cleaned_text,
-                                        'description': cleaned_text, # Принудительно используем очищенный текст
-                                        'posted_at': msg.date.isoformat(),
-                                        'post_link': post_link,
-                                        'raw_channel_id': entity.id,
-                                        'is_event_filtered': original_is_event,
-                                        'author_username': author_username,
-                                        'author_link': author_link,
-                                        'city': channel.get('City')
-                                    }
-                                    
-                                    # Добавляем картинку только если она есть, чтобы сработал дефолт в БД
-                                    if image_url:
-                                        final_post_data['image'] = image_url
-                                        final_post_data['image_url'] = image_url
-
-                                    # ЛОГИКА: если link_contact пуст, используем author_username
-                                    if not final_post_data.get('link_contact'):
-                                        final_post_data['link_contact'] = author_username
-
-                                    # Финальная санитария ПЕРЕД добавлением в список
-                                    final_post_data = sanitize_data(final_post_data)
-                                    posts_to_insert.append(final_post_data)
-                                    print_success(f"  Событие из сообщения {msg.id} добавлено в очередь на вставку.")
+                                if hasattr(entity, 'username') and entity.username:
+                                    base_link = f"https://t.me/{entity.username}"
+                                else:
+                                    base_link = f"https://t.me/c/{abs(entity.id)}"
 
+                                if thread_id_param is not None and thread_id_param != 1:
+                                    post_link = f"{base_link}/{thread_id_param}/{msg.id}"
+                                else:
+                                    post_link = f"{base_link}/{msg.id}"
+
+                                author_username = ""
+                                author_link = ""
+                                if msg.sender:
+                                    if hasattr(msg.sender, 'username') and msg.sender.username:
+                                        author_username = msg.sender.username
+                                        author_link = f"https://t.me/{msg.sender.username}"
+                                    elif hasattr(msg.sender, 'id'):
+                                        author_username = f"user_{msg.sender.id}"
+                                        author_link = ""
+
+                                # Собираем финальный объект для вставки
+                                final_post_data = {
+                                    **cleaned_data,
+                                    'channel_name': f"@{entity.username}" if hasattr(entity, 'username') and entity.username else f"channel_{entity.id}",
+                                    'message_id': msg.id,
+                                    'content': message_text,
+                                    'description': message_text, # Принудительно используем очищенный текст
+                                    'posted_at': msg.date.isoformat(),
+                                    'post_link': post_link,
+                                    'raw_channel_id': entity.id,
+                                    'is_event_filtered': original_is_event,
+                                    'author_username': author_username,
+                                    'author_link': author_link,
+                                    'city': channel.get('City')
+                                }
+
+                                # Ссылки из сущностей сообщения, если LLM их не заполнила
+                                if not final_post_data.get('link_site') and message_urls:
+                                    final_post_data['link_site'] = message_urls[0]
+                                if not final_post_data.get('link_contact') and message_usernames:
+                                    final_post_data['link_contact'] = message_usernames[0]
+
+                                # ЛОГИКА: если link_contact пуст, используем author_username
+                                if not final_post_data.get('link_contact'):
+                                    final_post_data['link_contact'] = author_username
+
+                                # Финальная санитария ПЕРЕД добавлением в список
+                                final_post_data = sanitize_data(final_post_data)
+                                posts_to_insert.append(final_post_data)
+                                print_success(f"  Событие из сообщения {msg.id} добавлено в очередь на вставку.")
+
+                            if media_task is not None:
+                                pending_media.append((msg.id, posts_to_insert[msg_rows_start:], media_task))
+                            else:
+                                state.journal_prepared(entity.id, msg.id, posts_to_insert[msg_rows_start:])
+                                if len(posts_to_insert) > msg_rows_start:
+                                    journal_pending_ids.append(msg.id)
 
-                        
+                        await attach_pending_media(state, entity.id, pending_media, journal_pending_ids)
                         if posts_to_insert:
-                            print_info(f"  Вставка {len(posts_to_insert)} записей в Supabase (таблицы posts и events)...")
+                            print_info(f"  Запись {len(posts_to_insert)} записей (таблицы posts и events)...")
                             try:
-                                # 1. Вставка в таблицу posts (лог)
-                                # ЛОГИКА: если city == 1, в posts НЕ сохраняем
-                                posts_for_log = [p for p in posts_to_insert if p.get('city') != 1]
-                                
-                                if posts_for_log:
-                                    # Разделяем на пачки с одинаковыми ключами, чтобы избежать ошибки PGRST102
-                                    posts_with_img = [p for p in posts_for_log if p.get('image')]
-                                    posts_no_img = [p for p in posts_for_log if not p.get('image')]
-
-                                    for batch in [posts_with_img, posts_no_img]:
-                                        if batch:
-                                            # Filter fields for posts table
-                                            batch = [filter_fields(p, ALLOWED_POST_FIELDS) for p in batch]
-                                            
-                                            # Гарантируем одинаковые наборы ключей внутри пачки
-                                            keys = set().union(*(d.keys() for d in batch))
-                                            for d in batch:
-                                                for k in keys:
-                                                    if k not in d: d[k] = None
-
-                                            resp = await http_client.post(f"{config['supabase_url']}/rest/v1/posts", headers=headers, json=batch)
-                                            resp.raise_for_status()
-                                    print_success(f"  Успешно вставлено {len(posts_for_log)} записей в таблицу 'posts'.")
-                                else:
-                                    print_info("  Пропуск вставки в 'posts' (все записи имеют city=1).")
-
-                                # 2. Вставка в таблицу events (всегда сохраняем валидные события)
-                                events_to_insert = []
-                                for p in posts_to_insert:
-                                    if p.get('is_event_filtered'):
-                                        event_entry = p.copy()
-                                        event_entry['isAuto'] = True
-                                        event_entry['author'] = '666408b4-1566-447b-a36c-0e36c9ebc96d'
-                                        
-                                        if not event_entry.get('description') and p.get('content'):
-                                            event_entry['description'] = p.get('content')
-                                        if p.get('posted_at'):
-                                            event_entry['created_at'] = p.get('posted_at')
-                                        if p.get('post_link'):
-                                            event_entry['link_site'] = p.get('post_link')
-                                        if not event_entry.get('link_contact'):
-                                            event_entry['link_contact'] = p.get('author_username')
-
-                                        # Note: Manual popping of tech_fields is no longer strictly necessary 
-                                        # because of filter_fields, but we keep the logic clean.
-                                        
-                                        # Если картинки нет — удаляем ключ (для дефолта БД)
-                                        if not event_entry.get('image'):
-                                            event_entry.pop('image', None)
-                                        
-                                        # --- DEDUPLICATION LOGIC START ---
-                                        current_title = event_entry.get('title')
-                                        current_day = event_entry.get('whenDay')
-
-                                        # A. Local Batch Deduplication
-                                        is_local_duplicate = False
-                                        for existing in events_to_insert:
-                                            if existing.get('title') == current_title and existing.get('whenDay') == current_day:
-                                                is_local_duplicate = True
-                                                break
-                                        
-                                        if is_local_duplicate:
-                                            print_info(f"    ⚠️ Пропуск локального дубликата: {current_title} ({current_day})")
-                                            continue
-
-                                        # B. Database Deduplication
-                                        if await check_event_exists_in_db(http_client, config, current_title, current_day, headers):
-                                            print_info(f"    ⚠️ Пропуск дубликата (найден в БД): {current_title} ({current_day})")
-                                            continue
-                                        # --- DEDUPLICATION LOGIC END ---
-
-                                        events_to_insert.append(event_entry)
-
-                                if events_to_insert:
-                                    # Также разделяем на пачки для events
-                                    ev_with_img = [e for e in events_to_insert if 'image' in e]
-                                    ev_no_img = [e for e in events_to_insert if 'image' not in e]
-
-                                    for ev_batch in [ev_with_img, ev_no_img]:
-                                        if ev_batch:
-                                            # Filter fields for events table
-                                            ev_batch = [filter_fields(e, ALLOWED_EVENT_FIELDS) for e in ev_batch]
-
-                                            # Гарантируем одинаковые наборы ключей внутри пачки
-                                            keys = set().union(*(d.keys() for d in ev_batch))
-                                            for d in ev_batch:
-                                                for k in keys:
-                                                    if k not in d: d[k] = None
-
-                                            resp = await http_client.post(f"{config['supabase_url']}/rest/v1/events", headers=headers, json=ev_batch)
-                                            if resp.status_code not in [200, 201, 204]:
-                                                print_error(f"  ОШИБКА 'events': {resp.status_code} - {resp.text}")
-                                            else:
-                                                print_success(f"  Успешно вставлено {len(ev_batch)} записей в таблицу 'events'.")
-
+                                await queue_posts_and_events(sink, state, posts_to_insert,
+                                                             entity.id, journal_pending_ids,
+                                                             dedup_index, fuzzy_index)
                                 posts_to_insert = []
+                                journal_pending_ids = []
                             except Exception as e:
                                 print_error(f"  Критическая ошибка вставки: {e}")
 
-                    # Обновление last_processed_message_id
+                        if stop_before_id is not None:
+                            topic_max_id = min(topic_max_id, stop_before_id - 1)
+                        if thread_id_param is not None and topic_max_id > topic_min_id and not lease_lost.is_set():
+                            state.set_topic_checkpoint(entity.id, thread_id_param, topic_max_id)
+                        if stop_before_id is not None:
+                            break
+
+                    # Канальный чекпоинт не должен перешагнуть необработанное сообщение (его топик мог быть без чекпоинта)
+                    if stop_before_id is not None:
+                        max_id_overall = min(max_id_overall, stop_before_id - 1)
+
+                    # Обновление last_processed_message_id и статистики канала
+                    state_update = {}
                     if max_id_overall > last_id:
                         print_info(f"  Обновление last_processed_message_id на {max_id_overall}...")
-                        update_response = await http_client.patch(
-                            f"{config['supabase_url']}/rest/v1/channel_sync_state?channel_name=eq.{channel.get('channel_name')}",
-                            headers=headers,
-                            json={'last_processed_message_id': max_id_overall}
-                        )
-                        if update_response.status_code in [200, 204]:
-                            print_success(f"  Состояние для канала {channel_name} обновлено.")
+                        state_update['last_processed_message_id'] = max_id_overall
+                    if channel_messages_seen:
+                        state_update['stat_messages_seen'] = (channel.get('stat_messages_seen') or 0) + channel_messages_seen
+                        state_update['stat_llm_calls'] = (channel.get('stat_llm_calls') or 0) + channel_llm_calls
+                        state_update['stat_events_imported'] = (channel.get('stat_events_imported') or 0) + channel_events
+                        state_update['last_activity_at'] = channel_last_activity.isoformat()
+                    if config['adaptive_polling']:
+                        state_update.update(schedule_next_poll(channel, channel_messages_seen, poll_started_at, config, channel_completed))
+
+                    if lease_lost.is_set():
+                        # Канал уже у другого воркера: его чекпоинт не перезаписываем
+                        print_error(f"  Аренда канала {channel_name} потеряна: состояние канала не обновляется.")
+                        channel_completed = False
+                        state_update = {}
+                    if state_update:
+                        update_channel_state(state, channel, state_update, entity.id)
+                        print_success(f"  Обновление состояния канала {channel_name} поставлено в очередь.")
+                        if 'last_processed_message_id' in state_update:
                             total_synced += 1
-                        else:
-                            print_error(f"  Ошибка обновления состояния: {update_response.text}")
+
+                    # pts сохраняем, только если канал обработан целиком — иначе следующий запуск его пропустит
+                    if new_pts is not None and channel_completed:
+                        state.set_channel_pts(entity.id, new_pts, channel.get('thread_id'))
                 
                 except Exception as e:
                     print_error(f"Критическая ошибка при обработке канала {channel_name}: {e}")
+                    for _, _, task in pending_media:
+                        task.cancel()
+                    # access_hash из кэша мог устареть — сбрасываем, в следующий раз канал будет резолвиться заново
+                    if entity_from_cache and entity is not None and is_entity_cache_error(e):
+                        state.invalidate_entity(entity.id)
+                        print_info(f"  Запись канала {channel_name} удалена из кэша сущностей.")
                     continue
+                finally:
+                    if lease_task is not None:
+                        lease_task.cancel()
+                        # Чекпоинт должен попасть в базу до того, как канал сможет взять другой воркер
+                        try:
+                            await flush_outbox(sink, state, config)
+                        except Exception as e:
+                            # Записи остаются в outbox; ошибка не должна прерывать импорт остальных каналов
+                            print_error(f"  Не удалось отправить outbox перед освобождением канала: {e}")
+                        await release_channel_lease(http_client, config, headers, channel)
             
+            # Дописываем очередь до конца; что не ушло — останется в outbox до следующего запуска
+            outbox_task.cancel()
+            outbox_flushed = await flush_outbox(sink, state, config)
+            outbox_counts = state.outbox_counts()
+            if not outbox_flushed:
+                print_error(f"Outbox: в очереди остались записи ({outbox_counts}).")
+            elif outbox_counts.get('dead'):
+                print_error(f"Outbox: {outbox_counts['dead']} записей с постоянной ошибкой (status=dead).")
+
             result = {
                 'status': 'success',
                 'channels_synced': total_synced,
                 'total_channels': len(channels),
                 'messages_processed': total_messages_processed,
                 'events_imported': total_events_imported,
+                'llm_calls': llm_calls_used,
+                'outbox_pending': outbox_counts.get('pending', 0),
+                'sink_write_seconds': round(sink.write_seconds, 2),
                 'timestamp': datetime.now().isoformat()
             }
             return result
@@ -1052,7 +2011,12 @@ async def import_and_process_messages():
         print_error(error_msg)
         return None
     finally:
+        if image_pool is not None:
+            image_pool.shutdown(cancel_futures=True)
+        if sink is not None:
+            await sink.close()
         await client.disconnect()
+        state.close()
         print_info("Отключились от Telegram.")
 
 def main():
@@ -0,0 +1,8 @@
+-- Статистика каналов для планировщика импортера (scripts/unified_importer.py).
+-- Каналы обрабатываются в порядке ожидаемого числа событий на один вызов LLM.
+
+ALTER TABLE public.channel_sync_state
+    ADD COLUMN IF NOT EXISTS stat_messages_seen bigint NOT NULL DEFAULT 0,
+    ADD COLUMN IF NOT EXISTS stat_llm_calls bigint NOT NULL DEFAULT 0,
+    ADD COLUMN IF NOT EXISTS stat_events_imported bigint NOT NULL DEFAULT 0,
+    ADD COLUMN IF NOT EXISTS last_activity_at timestamptz;
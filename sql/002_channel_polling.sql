@@ -0,0 +1,7 @@
+-- Адаптивные интервалы опроса каналов (scripts/unified_importer.py).
+-- Импортер оценивает частоту сообщений канала и назначает время следующего опроса.
+
+ALTER TABLE public.channel_sync_state
+    ADD COLUMN IF NOT EXISTS msg_rate_per_day double precision,
+    ADD COLUMN IF NOT EXISTS last_polled_at timestamptz,
+    ADD COLUMN IF NOT EXISTS next_poll_at timestamptz;
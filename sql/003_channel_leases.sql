@@ -0,0 +1,10 @@
+-- Аренда каналов для нескольких процессов импортера (CHANNEL_LEASES=true).
+-- Воркер захватывает строку условным PATCH (свободна / аренда истекла / уже своя),
+-- продлевает аренду во время работы и освобождает ее по окончании.
+
+ALTER TABLE public.channel_sync_state
+    ADD COLUMN IF NOT EXISTS lease_owner text,
+    ADD COLUMN IF NOT EXISTS lease_expires_at timestamptz;
+
+CREATE INDEX IF NOT EXISTS channel_sync_state_lease_expires_at_idx
+    ON public.channel_sync_state (lease_expires_at);
@@ -0,0 +1,48 @@
+-- Естественные ключи для идемпотентной записи (upsert через PostgREST on_conflict).
+-- posts:  (raw_channel_id, message_id, whenDay, title) — NULLS NOT DISTINCT, т.к. у не-событий
+--         whenDay и title пустые.
+-- events: (channel_name, message_id, whenDay, title) — обычный уникальный индекс: у событий, созданных
+--         вручную, message_id пустой, и они не должны конфликтовать друг с другом.
+-- title входит в ключ: одно сообщение может описывать несколько разных событий в один день.
+-- Требуется PostgreSQL 15+ (Supabase).
+
+BEGIN;
+
+-- Удаляем только настоящие дубликаты — строки с одинаковым ключом (оставляем самую раннюю).
+-- row_number() по разбиению считает NULL равными, как NULLS NOT DISTINCT, и обходится
+-- одной сортировкой вместо самосоединения по IS NOT DISTINCT FROM.
+DELETE FROM public.posts
+WHERE id IN (
+    SELECT id FROM (
+        SELECT id, row_number() OVER (
+            PARTITION BY raw_channel_id, message_id, "whenDay", title ORDER BY id
+        ) AS n
+        FROM public.posts
+    ) ranked
+    WHERE n > 1
+);
+
+DELETE FROM public.events
+WHERE id IN (
+    SELECT id FROM (
+        SELECT id, row_number() OVER (
+            PARTITION BY channel_name, message_id, "whenDay", title ORDER BY id
+        ) AS n
+        FROM public.events
+        WHERE channel_name IS NOT NULL AND message_id IS NOT NULL
+          AND "whenDay" IS NOT NULL AND title IS NOT NULL
+    ) ranked
+    WHERE n > 1
+);
+
+-- Индексы пересоздаются: ранняя версия миграции строила их без title
+DROP INDEX IF EXISTS public.posts_natural_key;
+DROP INDEX IF EXISTS public.events_natural_key;
+
+CREATE UNIQUE INDEX posts_natural_key
+    ON public.posts (raw_channel_id, message_id, "whenDay", title) NULLS NOT DISTINCT;
+
+CREATE UNIQUE INDEX events_natural_key
+    ON public.events (channel_name, message_id, "whenDay", title);
+
+COMMIT;
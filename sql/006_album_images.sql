@@ -0,0 +1,193 @@
+-- Все фото альбома (сообщения с общим grouped_id) у записи: колонка images со списком URL.
+-- image и image_url по-прежнему содержат первое фото (обложку карточки).
+-- Функция ingest_channel_batch из 005_ingest_rpc.sql пересоздается с новой колонкой,
+-- остальная логика не меняется.
+
+ALTER TABLE public.posts ADD COLUMN IF NOT EXISTS images text[];
+ALTER TABLE public.events ADD COLUMN IF NOT EXISTS images text[];
+
+CREATE OR REPLACE FUNCTION public.ingest_channel_batch(payload jsonb)
+RETURNS jsonb
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    posts_written integer := 0;
+    events_written integer := 0;
+    states_written integer := 0;
+    n integer;
+    st jsonb;
+    d jsonb;
+BEGIN
+    -- 1. posts (служебный лог): повтор обновляет запись
+    INSERT INTO public.posts (
+        channel_name, message_id, content, posted_at, is_event_filtered, is_event,
+        post_link, raw_channel_id, image_url, title, title_dop, description, "whenDay",
+        "whenTime", link_site, price, "where", author, link_map, link_contact,
+        "isAvailable", city, currency, "isPriceFrom", category, "isOnline",
+        author_username, author_link, image, images
+    )
+    SELECT DISTINCT ON (r.raw_channel_id, r.message_id, r."whenDay", r.title)
+        r.channel_name, r.message_id, r.content, r.posted_at, r.is_event_filtered,
+        r.is_event, r.post_link, r.raw_channel_id, r.image_url, r.title, r.title_dop,
+        r.description, r."whenDay", r."whenTime", r.link_site, r.price, r."where",
+        r.author, r.link_map, r.link_contact, r."isAvailable", r.city, r.currency,
+        r."isPriceFrom", r.category, r."isOnline", r.author_username, r.author_link,
+        r.image, r.images
+    FROM jsonb_array_elements(coalesce(payload->'posts', '[]')) doc,
+         jsonb_populate_record(NULL::public.posts, doc) r
+    WHERE (jsonb_typeof(doc->'image') IS DISTINCT FROM 'null' AND doc ? 'image')
+    ON CONFLICT (raw_channel_id, message_id, "whenDay", title) DO UPDATE SET
+        channel_name = EXCLUDED.channel_name,
+        content = EXCLUDED.content,
+        posted_at = EXCLUDED.posted_at,
+        is_event_filtered = EXCLUDED.is_event_filtered,
+        is_event = EXCLUDED.is_event,
+        post_link = EXCLUDED.post_link,
+        image_url = EXCLUDED.image_url,
+        title = EXCLUDED.title,
+        title_dop = EXCLUDED.title_dop,
+        description = EXCLUDED.description,
+        "whenTime" = EXCLUDED."whenTime",
+        link_site = EXCLUDED.link_site,
+        price = EXCLUDED.price,
+        "where" = EXCLUDED."where",
+        author = EXCLUDED.author,
+        link_map = EXCLUDED.link_map,
+        link_contact = EXCLUDED.link_contact,
+        "isAvailable" = EXCLUDED."isAvailable",
+        city = EXCLUDED.city,
+        currency = EXCLUDED.currency,
+        "isPriceFrom" = EXCLUDED."isPriceFrom",
+        category = EXCLUDED.category,
+        "isOnline" = EXCLUDED."isOnline",
+        author_username = EXCLUDED.author_username,
+        author_link = EXCLUDED.author_link,
+        image = EXCLUDED.image,
+        images = EXCLUDED.images;
+    GET DIAGNOSTICS n = ROW_COUNT;
+    posts_written := posts_written + n;
+
+    INSERT INTO public.posts (
+        channel_name, message_id, content, posted_at, is_event_filtered, is_event,
+        post_link, raw_channel_id, image_url, title, title_dop, description, "whenDay",
+        "whenTime", link_site, price, "where", author, link_map, link_contact,
+        "isAvailable", city, currency, "isPriceFrom", category, "isOnline",
+        author_username, author_link, images
+    )
+    SELECT DISTINCT ON (r.raw_channel_id, r.message_id, r."whenDay", r.title)
+        r.channel_name, r.message_id, r.content, r.posted_at, r.is_event_filtered,
+        r.is_event, r.post_link, r.raw_channel_id, r.image_url, r.title, r.title_dop,
+        r.description, r."whenDay", r."whenTime", r.link_site, r.price, r."where",
+        r.author, r.link_map, r.link_contact, r."isAvailable", r.city, r.currency,
+        r."isPriceFrom", r.category, r."isOnline", r.author_username, r.author_link,
+        r.images
+    FROM jsonb_array_elements(coalesce(payload->'posts', '[]')) doc,
+         jsonb_populate_record(NULL::public.posts, doc) r
+    WHERE NOT (jsonb_typeof(doc->'image') IS DISTINCT FROM 'null' AND doc ? 'image')
+    ON CONFLICT (raw_channel_id, message_id, "whenDay", title) DO UPDATE SET
+        channel_name = EXCLUDED.channel_name,
+        content = EXCLUDED.content,
+        posted_at = EXCLUDED.posted_at,
+        is_event_filtered = EXCLUDED.is_event_filtered,
+        is_event = EXCLUDED.is_event,
+        post_link = EXCLUDED.post_link,
+        image_url = EXCLUDED.image_url,
+        title = EXCLUDED.title,
+        title_dop = EXCLUDED.title_dop,
+        description = EXCLUDED.description,
+        "whenTime" = EXCLUDED."whenTime",
+        link_site = EXCLUDED.link_site,
+        price = EXCLUDED.price,
+        "where" = EXCLUDED."where",
+        author = EXCLUDED.author,
+        link_map = EXCLUDED.link_map,
+        link_contact = EXCLUDED.link_contact,
+        "isAvailable" = EXCLUDED."isAvailable",
+        city = EXCLUDED.city,
+        currency = EXCLUDED.currency,
+        "isPriceFrom" = EXCLUDED."isPriceFrom",
+        category = EXCLUDED.category,
+        "isOnline" = EXCLUDED."isOnline",
+        author_username = EXCLUDED.author_username,
+        author_link = EXCLUDED.author_link,
+        images = EXCLUDED.images;
+    GET DIAGNOSTICS n = ROW_COUNT;
+    posts_written := posts_written + n;
+
+    -- 2. events: одно событие на (название без учета регистра, день), уже существующие
+    --    пропускаем; вручную отредактированные строки не трогаем.
+    --    Вторая вставка видит строки первой, поэтому дубликаты между ними тоже отсекаются.
+    INSERT INTO public.events (
+        created_at, title, title_dop, description, "whenDay", "whenTime", link_site,
+        price, "where", author, link_map, link_contact, "isAvailable", city, currency,
+        "isPriceFrom", category, "isAuto", "isOnline", author_username, author_link,
+        post_link, message_id, channel_name, image, images
+    )
+    SELECT DISTINCT ON (lower(r.title), r."whenDay")
+        r.created_at, r.title, r.title_dop, r.description, r."whenDay", r."whenTime",
+        r.link_site, r.price, r."where", r.author, r.link_map, r.link_contact,
+        r."isAvailable", r.city, r.currency, r."isPriceFrom", r.category, r."isAuto",
+        r."isOnline", r.author_username, r.author_link, r.post_link, r.message_id,
+        r.channel_name, r.image, r.images
+    FROM jsonb_array_elements(coalesce(payload->'events', '[]')) doc,
+         jsonb_populate_record(NULL::public.events, doc) r
+    WHERE (jsonb_typeof(doc->'image') IS DISTINCT FROM 'null' AND doc ? 'image')
+      AND NOT EXISTS (
+          SELECT 1 FROM public.events e
+          WHERE lower(e.title) = lower(r.title) AND e."whenDay" = r."whenDay"
+      )
+    ORDER BY lower(r.title), r."whenDay"
+    ON CONFLICT (channel_name, message_id, "whenDay", title) DO NOTHING;
+    GET DIAGNOSTICS n = ROW_COUNT;
+    events_written := events_written + n;
+
+    INSERT INTO public.events (
+        created_at, title, title_dop, description, "whenDay", "whenTime", link_site,
+        price, "where", author, link_map, link_contact, "isAvailable", city, currency,
+        "isPriceFrom", category, "isAuto", "isOnline", author_username, author_link,
+        post_link, message_id, channel_name, images
+    )
+    SELECT DISTINCT ON (lower(r.title), r."whenDay")
+        r.created_at, r.title, r.title_dop, r.description, r."whenDay", r."whenTime",
+        r.link_site, r.price, r."where", r.author, r.link_map, r.link_contact,
+        r."isAvailable", r.city, r.currency, r."isPriceFrom", r.category, r."isAuto",
+        r."isOnline", r.author_username, r.author_link, r.post_link, r.message_id,
+        r.channel_name, r.images
+    FROM jsonb_array_elements(coalesce(payload->'events', '[]')) doc,
+         jsonb_populate_record(NULL::public.events, doc) r
+    WHERE NOT (jsonb_typeof(doc->'image') IS DISTINCT FROM 'null' AND doc ? 'image')
+      AND NOT EXISTS (
+          SELECT 1 FROM public.events e
+          WHERE lower(e.title) = lower(r.title) AND e."whenDay" = r."whenDay"
+      )
+    ORDER BY lower(r.title), r."whenDay"
+    ON CONFLICT (channel_name, message_id, "whenDay", title) DO NOTHING;
+    GET DIAGNOSTICS n = ROW_COUNT;
+    events_written := events_written + n;
+
+    -- 3. Чекпоинт и статистика каналов — после данных, в той же транзакции
+    FOR st IN SELECT * FROM jsonb_array_elements(coalesce(payload->'channel_states', '[]'))
+    LOOP
+        d := st->'data';
+        UPDATE public.channel_sync_state c SET
+            last_processed_message_id = CASE WHEN d ? 'last_processed_message_id'
+                THEN greatest(c.last_processed_message_id, (d->>'last_processed_message_id')::bigint)
+                ELSE c.last_processed_message_id END,
+            stat_messages_seen = coalesce((d->>'stat_messages_seen')::bigint, c.stat_messages_seen),
+            stat_llm_calls = coalesce((d->>'stat_llm_calls')::bigint, c.stat_llm_calls),
+            stat_events_imported = coalesce((d->>'stat_events_imported')::bigint, c.stat_events_imported),
+            last_activity_at = coalesce((d->>'last_activity_at')::timestamptz, c.last_activity_at),
+            msg_rate_per_day = coalesce((d->>'msg_rate_per_day')::double precision, c.msg_rate_per_day),
+            last_polled_at = coalesce((d->>'last_polled_at')::timestamptz, c.last_polled_at),
+            next_poll_at = coalesce((d->>'next_poll_at')::timestamptz, c.next_poll_at)
+        WHERE CASE WHEN st ? 'id' THEN c.id::text = st->>'id'
+                   ELSE c.channel_name = st->>'channel_name' END;
+        GET DIAGNOSTICS n = ROW_COUNT;
+        states_written := states_written + n;
+    END LOOP;
+
+    RETURN jsonb_build_object('posts', posts_written, 'events', events_written, 'channel_states', states_written);
+END;
+$$;
+
+GRANT EXECUTE ON FUNCTION public.ingest_channel_batch(jsonb) TO service_role;
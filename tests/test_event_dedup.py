@@ -0,0 +1,46 @@
+"""
+Нечеткая дедупликация событий (FuzzyEventIndex).
+
+Запуск: python -m pytest tests
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(__file__)), 'scripts'))
+
+from event_dedup import FuzzyEventIndex  # noqa: E402
+
+DAY = '2026-11-20'
+
+
+def make_index(*events) -> FuzzyEventIndex:
+    index = FuzzyEventIndex(0.8, since='2026-01-01')
+    for event in events:
+        index.add(event)
+    return index
+
+
+def test_same_title_different_venue_is_duplicate():
+    index = make_index({'title': 'Концерт Джаз-бэнд', 'whenDay': DAY, 'where': 'Бар Луна'})
+    assert index.find({'title': 'Концерт Джаз-бэнд', 'whenDay': DAY, 'where': 'ул. Ленина, 5'}) == 'Концерт Джаз-бэнд'
+
+
+def test_same_title_after_normalization_is_duplicate():
+    index = make_index({'title': 'Концерт Джаз-бэнд', 'whenDay': DAY})
+    assert index.find({'title': 'КОНЦЕРТ «джаз бэнд»!', 'whenDay': DAY, 'where': 'Бар Луна'}) == 'Концерт Джаз-бэнд'
+
+
+def test_reordered_title_is_duplicate():
+    index = make_index({'title': 'Концерт Джаз-бэнд', 'whenDay': DAY, 'where': 'Бар Луна'})
+    assert index.find({'title': 'Джаз-бэнд: концерт', 'whenDay': DAY, 'where': 'Бар «Луна»'}) == 'Концерт Джаз-бэнд'
+
+
+def test_other_day_is_not_duplicate():
+    index = make_index({'title': 'Концерт Джаз-бэнд', 'whenDay': DAY})
+    assert index.find({'title': 'Концерт Джаз-бэнд', 'whenDay': '2026-11-21'}) is None
+
+
+def test_different_title_is_not_duplicate():
+    index = make_index({'title': 'Концерт Джаз-бэнд', 'whenDay': DAY, 'where': 'Бар Луна'})
+    assert index.find({'title': 'Лекция об истории города', 'whenDay': DAY, 'where': 'Бар Луна'}) is None
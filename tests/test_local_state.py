@@ -0,0 +1,34 @@
+"""
+Файл состояния на воркер (LocalState.open_exclusive).
+
+Запуск: python -m pytest tests
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(__file__)), 'scripts'))
+
+from local_state import LocalState  # noqa: E402
+
+
+def test_second_worker_gets_its_own_file(tmp_path):
+    path = str(tmp_path / 'importer_state.db')
+    first = LocalState.open_exclusive(path)
+    second = LocalState.open_exclusive(path)
+    try:
+        assert first.path == path
+        assert second.path == str(tmp_path / 'importer_state.1.db')
+    finally:
+        first.close()
+        second.close()
+
+
+def test_file_is_reused_after_close(tmp_path):
+    path = str(tmp_path / 'importer_state.db')
+    LocalState.open_exclusive(path).close()
+    state = LocalState.open_exclusive(path)
+    try:
+        assert state.path == path
+    finally:
+        state.close()
@@ -0,0 +1,68 @@
+"""
+Проверка примененных миграций при старте (find_missing_migrations) на замене PostgREST.
+
+Запуск: python -m pytest tests
+"""
+
+import asyncio
+import os
+import sys
+
+import httpx
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(__file__)), 'scripts'))
+
+import unified_importer as ui  # noqa: E402
+
+MIGRATED_CHANNEL = {
+    'id': 1, 'stat_messages_seen': 0, 'stat_llm_calls': 0, 'stat_events_imported': 0, 'last_activity_at': None,
+    'msg_rate_per_day': None, 'last_polled_at': None, 'next_poll_at': None,
+}
+
+
+def postgrest(applied: set) -> httpx.MockTransport:
+    """Отвечает так, как PostgREST отвечает на базе, где применены только миграции из applied."""
+    def handler(request: httpx.Request) -> httpx.Response:
+        path = request.url.path
+        if path == '/rest/v1/rpc/ingest_channel_batch':
+            return httpx.Response(200, json={}) if '005' in applied else httpx.Response(404, json={'code': 'PGRST202'})
+        if request.method == 'POST' and 'on_conflict' in request.url.params:
+            return httpx.Response(201) if '004' in applied else httpx.Response(400, json={'code': '42P10'})
+        if request.url.params.get('select') == 'images':
+            return httpx.Response(200, json=[]) if '006' in applied else httpx.Response(400, json={'code': '42703'})
+        return httpx.Response(200, json=[])
+    return httpx.MockTransport(handler)
+
+
+def find_missing(applied: set, channels: list, **overrides) -> list:
+    config = {'supabase_url': 'http://postgrest', 'adaptive_polling': False, 'channel_leases': False,
+              'sink': 'supabase', 'use_ingest_rpc': False, **overrides}
+
+    async def run():
+        async with httpx.AsyncClient(transport=postgrest(applied)) as client:
+            return await ui.find_missing_migrations(client, config, {}, channels)
+    return asyncio.run(run())
+
+
+def test_fully_migrated_database():
+    assert find_missing({'004', '005', '006'}, [MIGRATED_CHANNEL], use_ingest_rpc=True, adaptive_polling=True) == []
+
+
+def test_missing_natural_keys():
+    assert find_missing({'005', '006'}, [MIGRATED_CHANNEL]) == ['sql/004_natural_keys.sql']
+
+
+@pytest.mark.parametrize('overrides', [{'use_ingest_rpc': True}, {'sink': 'postgres'}])
+def test_ingest_rpc_needs_function_and_polling_columns(overrides):
+    channel = {k: v for k, v in MIGRATED_CHANNEL.items() if k not in ('msg_rate_per_day', 'last_polled_at', 'next_poll_at')}
+    assert find_missing({'004', '006'}, [channel], **overrides) == ['sql/002_channel_polling.sql', 'sql/005_ingest_rpc.sql']
+
+
+def test_rest_upserts_do_not_need_function_or_polling_columns():
+    channel = {k: v for k, v in MIGRATED_CHANNEL.items() if k not in ('msg_rate_per_day', 'last_polled_at', 'next_poll_at')}
+    assert find_missing({'004', '006'}, [channel]) == []
+
+
+def test_missing_album_images():
+    assert find_missing({'004'}, [MIGRATED_CHANNEL]) == ['sql/006_album_images.sql']
@@ -0,0 +1,108 @@
+"""
+Отправка outbox (flush_outbox): деление пачки при постоянной ошибке и отложенные чекпоинты.
+
+Запуск: python -m pytest tests
+"""
+
+import asyncio
+import os
+import sys
+
+import httpx
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(__file__)), 'scripts'))
+
+import unified_importer as ui  # noqa: E402
+from local_state import LocalState  # noqa: E402
+from sinks import Sink  # noqa: E402
+
+
+class RejectingSink(Sink):
+    """Отвергает (400) любую пачку, в которой есть строка с полем bad, и запоминает записанное."""
+
+    name = 'test'
+
+    def __init__(self, transactional: bool):
+        super().__init__()
+        self.transactional = transactional
+        self.posts, self.events, self.channel_states = [], [], []
+
+    async def write_batch(self, posts: list, events: list, channel_states: list):
+        if any(row.get('bad') for row in posts + events):
+            request = httpx.Request('POST', 'http://test')
+            raise httpx.HTTPStatusError('bad', request=request, response=httpx.Response(400, request=request, text='bad'))
+        self.posts += posts
+        self.events += events
+        self.channel_states += channel_states
+
+    async def write_posts(self, rows: list):
+        await self.write_batch(rows, [], [])
+
+    async def write_events(self, rows: list):
+        await self.write_batch([], rows, [])
+
+    async def write_channel_state(self, match: dict, data: dict):
+        await self.write_batch([], [], [{**match, 'data': data}])
+
+    async def update_post(self, post_id, data: dict):
+        pass
+
+    def is_permanent_error(self, e: Exception) -> bool:
+        return isinstance(e, httpx.HTTPStatusError)
+
+
+@pytest.fixture
+def state(tmp_path):
+    ui.setup_logging()
+    local_state = LocalState(str(tmp_path / 'state.db'))
+    yield local_state
+    local_state.close()
+
+
+def queue_channel(state: LocalState, channel_id: int, posts: list, events: list, checkpoint: int):
+    state.enqueue_writes([('posts', posts, {'channel_id': channel_id}), ('events', events, {'channel_id': channel_id})])
+    state.enqueue_writes([('channel_state', {'last_processed_message_id': checkpoint},
+                           {'filter': {'id': f'eq.{channel_id}'}, 'channel_id': channel_id})])
+
+
+@pytest.mark.parametrize('transactional', [True, False])
+def test_bad_row_goes_dead_alone_and_holds_only_its_channel(state, transactional):
+    queue_channel(state, 1, [{'m': 1}], [{'m': 1, 'bad': True}], 10)
+    queue_channel(state, 2, [{'m': 2}], [{'m': 2}], 20)
+    sink = RejectingSink(transactional)
+
+    assert asyncio.run(ui.flush_outbox(sink, state, {'outbox_batch_size': 500}))
+
+    # Пост канала 1 и все данные канала 2 записаны, в dead — плохое событие и чекпоинт канала 1
+    assert sink.posts == [{'m': 1}, {'m': 2}]
+    assert sink.events == [{'m': 2}]
+    assert [cs['id'] for cs in sink.channel_states] == ['2']
+    assert state.outbox_counts() == {'dead': 2}
+
+
+def test_checkpoint_stays_held_while_channel_data_is_dead(state):
+    queue_channel(state, 1, [{'m': 1}], [{'m': 1, 'bad': True}], 10)
+    sink = RejectingSink(True)
+    asyncio.run(ui.flush_outbox(sink, state, {'outbox_batch_size': 500}))
+
+    # Следующий запуск: данные канала уже в журнале, новый чекпоинт не должен перешагнуть dead
+    state.enqueue_writes([('channel_state', {'last_processed_message_id': 11},
+                           {'filter': {'id': 'eq.1'}, 'channel_id': 1})])
+    asyncio.run(ui.flush_outbox(sink, state, {'outbox_batch_size': 500}))
+    assert sink.channel_states == []
+    assert state.outbox_counts() == {'dead': 3}
+
+
+def test_requeue_sends_data_then_held_checkpoint(state):
+    queue_channel(state, 1, [{'m': 1}], [{'m': 1, 'bad': True}], 10)
+    sink = RejectingSink(True)
+    asyncio.run(ui.flush_outbox(sink, state, {'outbox_batch_size': 500}))
+
+    # Данные исправлены (например, применена миграция) — возвращаем dead в очередь
+    state.conn.execute("UPDATE outbox SET payload = '[{\"m\": 1}]' WHERE kind = 'events'")
+    assert state.outbox_requeue_dead() == 2
+    assert asyncio.run(ui.flush_outbox(sink, state, {'outbox_batch_size': 500}))
+    assert sink.events == [{'m': 1}]
+    assert [cs['data'] for cs in sink.channel_states] == [{'last_processed_message_id': 10}]
+    assert state.outbox_counts() == {}
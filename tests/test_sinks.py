@@ -0,0 +1,54 @@
+"""
+Естественные ключи приемников (dedupe_by_key) и пачка PostgresSink.
+
+Запуск: python -m pytest tests
+"""
+
+import asyncio
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(__file__)), 'scripts'))
+
+from pg_sink import PostgresSink  # noqa: E402
+from sinks import EVENTS_CONFLICT_KEY, POSTS_CONFLICT_KEY, dedupe_by_key  # noqa: E402
+
+DAY = '2026-11-20'
+
+
+def test_events_from_one_message_on_one_day_are_kept():
+    rows = [
+        {'channel_name': 'afisha', 'message_id': 7, 'whenDay': DAY, 'title': 'Концерт'},
+        {'channel_name': 'afisha', 'message_id': 7, 'whenDay': DAY, 'title': 'Лекция'},
+    ]
+    assert dedupe_by_key(rows, EVENTS_CONFLICT_KEY) == rows
+
+
+def test_true_duplicates_keep_last_row():
+    first = {'raw_channel_id': -1, 'message_id': 7, 'whenDay': DAY, 'title': 'Концерт', 'content': 'старый'}
+    last = {**first, 'content': 'новый'}
+    assert dedupe_by_key([first, last], POSTS_CONFLICT_KEY) == [last]
+
+
+class RecordingPool:
+    """Вместо пула asyncpg: запоминает запросы и отвечает, как ingest_channel_batch."""
+
+    def __init__(self):
+        self.calls = []
+
+    async def fetchval(self, query, *args):
+        self.calls.append((query, args))
+        return json.dumps({'posts': 1, 'events': 1})
+
+
+def test_postgres_sink_sends_batch_in_one_call():
+    pool = RecordingPool()
+    post = {'raw_channel_id': -1, 'message_id': 7, 'title': 'Концерт'}
+    event = {'channel_name': 'afisha', 'message_id': 7, 'title': 'Концерт'}
+    states = [{'id': 5, 'data': {'last_message_id': 7}}]
+    result = asyncio.run(PostgresSink(pool).write_batch([post], [event], states))
+    assert result == {'posts': 1, 'events': 1}
+    [(query, (payload,))] = pool.calls
+    assert 'ingest_channel_batch' in query
+    assert json.loads(payload) == {'posts': [post], 'events': [event], 'channel_states': states}
@@ -0,0 +1,29 @@
+"""
+Эталонные результаты text_cleaner на примерах анонсов из каналов.
+
+tests/fixtures/text_cleaner_golden.json — входной текст и ожидаемый результат
+normalize_text (получен прежней реализацией).
+Замер скорости — отдельно, в scripts/bench_text_cleaner.py.
+
+Запуск: python -m pytest tests
+"""
+
+import json
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(__file__)), 'scripts'))
+
+from text_cleaner import normalize_text  # noqa: E402
+
+FIXTURE_PATH = os.path.join(os.path.dirname(__file__), 'fixtures', 'text_cleaner_golden.json')
+
+with open(FIXTURE_PATH, 'r', encoding='utf-8') as f:
+    GOLDEN = json.load(f)
+
+
+@pytest.mark.parametrize('case', GOLDEN, ids=lambda case: case['text'][:30])
+def test_normalize_text(case):
+    assert normalize_text(case['text']) == case['normalize_text']